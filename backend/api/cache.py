@@ -0,0 +1,137 @@
+from functools import wraps
+from hashlib import md5
+from time import time
+
+from django.core.cache import cache
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+from recipes.models import Recipe
+from .utils import value_to_int
+
+RECIPES_GENERATION = 'recipes'
+RESPONSES_GENERATION = 'responses'
+CATALOG_GENERATION = 'catalog'
+TAGS_GENERATION = 'tags'
+INGREDIENTS_GENERATION = 'ingredients'
+PERSONAL_FILTERS = ('is_favorited', 'is_in_shopping_cart')
+ANONYMOUS_RESPONSE_TIMEOUT = 600
+RECIPE_BODY_TIMEOUT = 60 * 60 * 24
+
+
+def user_generation_name(user_id):
+    return f'user:{user_id}'
+
+
+def author_generation_name(user_id):
+    return f'author:{user_id}'
+
+
+def get_generation(name):
+    key = f'generation:{name}'
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, int(time() * 1000), None)
+        generation = cache.get(key)
+    return generation
+
+
+def get_generations(names):
+    keys = {name: f'generation:{name}' for name in names}
+    found = cache.get_many(list(keys.values()))
+    return {name: found[key] if key in found else get_generation(name)
+            for name, key in keys.items()}
+
+
+def bump_generation(name):
+    key = f'generation:{name}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time() * 1000), None)
+
+
+def recipe_count_key(request, filter_names):
+    params = request.query_params
+    values = [(name, sorted(params.getlist(name)))
+              for name in sorted(filter_names) if name in params]
+    generations = [get_generation(RECIPES_GENERATION)]
+    if (request.user.is_authenticated
+            and any(name in params for name in PERSONAL_FILTERS)):
+        generations.append(request.user.id)
+        generations.append(
+            get_generation(user_generation_name(request.user.id))
+        )
+    digest = md5(repr((generations, values)).encode()).hexdigest()
+    return f'recipes:count:{digest}'
+
+
+def get_cached_count(key, queryset):
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count)
+    return count
+
+
+def recipe_body_keys(recipes):
+    # Автор входит в тело рецепта, поэтому у каждого автора своё
+    # поколение: изменение одного пользователя не сбрасывает все тела.
+    generations = get_generations(
+        [CATALOG_GENERATION]
+        + [author_generation_name(recipe.author_id) for recipe in recipes]
+    )
+    catalog = generations[CATALOG_GENERATION]
+    return [f'recipe:body:{recipe.id}:{recipe.updated_at.timestamp()}:'
+            f'{catalog}:'
+            f'{generations[author_generation_name(recipe.author_id)]}'
+            for recipe in recipes]
+
+
+def cache_anonymous_response(view_method):
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return view_method(self, request, *args, **kwargs)
+        path = md5(request.get_full_path().encode()).hexdigest()
+        key = (f'recipes:anonymous:'
+               f'{get_generation(RESPONSES_GENERATION)}:{path}')
+        cached = cache.get(key)
+        if cached is not None:
+            # ETag хранится вместе с телом: оно меняется вместе с тем же
+            # поколением, и попадание в кеш обходится без запросов к БД.
+            data, etag = cached
+            if etag is None:
+                return Response(data)
+            if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH',
+                                                    '')):
+                return Response(status=status.HTTP_304_NOT_MODIFIED,
+                                headers={'ETag': etag})
+            return Response(data, headers={'ETag': etag})
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(key, (response.data, response.get('ETag')),
+                      ANONYMOUS_RESPONSE_TIMEOUT)
+        return response
+    return wrapper
+
+
+def generation_etag(name):
+    def etag_func(request, *args, **kwargs):
+        return f'{name}-{get_generation(name)}'
+    return etag_func
+
+
+def recipe_etag(request, pk=None, *args, **kwargs):
+    recipe = Recipe.objects.filter(
+        pk=value_to_int(pk)
+    ).only('id', 'updated_at', 'author_id').first()
+    if recipe is None:
+        return None
+    etag = f'recipe-{recipe_body_keys([recipe])[0]}'
+    if not request.user.is_authenticated:
+        return etag
+    user_id = request.user.id
+    return (f'{etag}-{user_id}-'
+            f'{get_generation(user_generation_name(user_id))}')
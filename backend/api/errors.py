@@ -1,3 +1,4 @@
+RECIPE_FAVORITE_ALLREADY_IN_ERROR = 'Рецепт уже добавлен в избранное'
 RECIPE_FAVORITE_ERROR = 'Рецепт ещё не добавлен в избранное'
 SHOPPING_CART_ALLREADY_IN_ERROR = 'Рецепт уже добавлен в корзину'
 SHOPPING_CART_NOT_IN_ERROR = 'Рецепт ещё не добавлен в корзину'
@@ -1,7 +1,37 @@
+from time import monotonic
+
+from django.db.models import Exists, OuterRef
 from django_filters import rest_framework as filters
 
 from recipes.models import Recipe, Tag
 from users.models import User
+from .cache import TAGS_GENERATION, get_generation
+
+TAG_IDS_TTL = 300
+
+
+class TagSlugMap:
+    def __init__(self):
+        self._ids = None
+        self._loaded_at = 0
+        self._generation = None
+
+    def invalidate(self):
+        self._ids = None
+
+    def get_ids(self, slugs):
+        ids = self._ids
+        generation = get_generation(TAGS_GENERATION)
+        expired = monotonic() - self._loaded_at > TAG_IDS_TTL
+        if ids is None or expired or generation != self._generation:
+            ids = dict(Tag.objects.values_list('slug', 'id'))
+            self._ids = ids
+            self._loaded_at = monotonic()
+            self._generation = generation
+        return [ids[slug] for slug in slugs if slug in ids]
+
+
+tag_slug_map = TagSlugMap()
 
 
 class RecipeFilter(filters.FilterSet):
@@ -10,9 +40,10 @@ class RecipeFilter(filters.FilterSet):
         method='get_is_in_shopping_cart'
     )
     author = filters.ModelChoiceFilter(queryset=User.objects.all())
-    tags = filters.ModelMultipleChoiceFilter(queryset=Tag.objects.all(),
-                                             field_name='tags__slug',
-                                             to_field_name='slug')
+    tags = filters.CharFilter(method='get_tags')
+    search = filters.CharFilter(method='get_search')
+    ordering = filters.ChoiceFilter(choices=(('popular', 'popular'),),
+                                    method='get_ordering')
 
     def get_is_favorited(self, queryset, name, value):
         if self.request.user.is_authenticated:
@@ -24,6 +55,21 @@ class RecipeFilter(filters.FilterSet):
             return queryset.filter(shopping_cart__user=self.request.user)
         return queryset
 
+    def get_tags(self, queryset, name, value):
+        tag_ids = tag_slug_map.get_ids(self.data.getlist(name))
+        if not tag_ids:
+            return queryset.none()
+        return queryset.filter(Exists(Recipe.tags.through.objects.filter(
+            recipe_id=OuterRef('pk'), tag_id__in=tag_ids
+        )))
+
+    def get_search(self, queryset, name, value):
+        return queryset.search(value)
+
+    def get_ordering(self, queryset, name, value):
+        return queryset.popular()
+
     class Meta:
         model = Recipe
-        fields = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart',)
+        fields = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart',
+                  'search', 'ordering',)
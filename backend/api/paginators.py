@@ -1,5 +1,101 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .cache import get_cached_count, recipe_count_key
 
 
 class PageLimitPagination(PageNumberPagination):
     page_size_query_param = "limit"
+
+
+class CachedCountPaginator(Paginator):
+    def __init__(self, *args, count_key, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count_key = count_key
+
+    @cached_property
+    def count(self):
+        return get_cached_count(self.count_key, self.object_list)
+
+
+class RecipePagination(PageLimitPagination):
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Неверный курсор'
+    # Курсор строится по (pub_date, id) и несовместим с другим порядком.
+    cursor_incompatible_params = ('ordering', 'search')
+    cursor_ordering_message = ('Курсор нельзя использовать вместе '
+                               'с параметрами ordering и search')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = self.cursor_query_param in request.query_params
+        count_key = recipe_count_key(
+            request, view.filterset_class.base_filters
+        )
+        if not self.use_cursor:
+            self.django_paginator_class = partial(CachedCountPaginator,
+                                                  count_key=count_key)
+            return super().paginate_queryset(queryset, request, view)
+        if any(request.query_params.get(name)
+               for name in self.cursor_incompatible_params):
+            raise ValidationError(
+                {self.cursor_query_param: self.cursor_ordering_message}
+            )
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('1', 'true'):
+            self.count = get_cached_count(count_key, queryset)
+        queryset = queryset.order_by('-pub_date', '-id')
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            pub_date, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk)
+            )
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[:self.page_size]
+        self.last = results[-1] if results else None
+        return results
+
+    def decode_cursor(self, cursor):
+        try:
+            pub_date, pk = b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(pub_date), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, recipe):
+        value = f'{recipe.pub_date.isoformat()}|{recipe.id}'
+        return b64encode(value.encode()).decode()
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(self.last))
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super().get_paginated_response(data)
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_next_link()
+        response['results'] = data
+        return Response(response)
@@ -0,0 +1,63 @@
+from bisect import bisect_left
+from time import monotonic
+
+from recipes.models import Ingredient
+from .cache import INGREDIENTS_GENERATION, get_generation
+
+INGREDIENT_SEARCH_LIMIT = 50
+INGREDIENT_INDEX_TTL = 300
+
+
+def normalize(value):
+    return value.strip().lower().replace('ё', 'е')
+
+
+class IngredientIndex:
+    def __init__(self):
+        self._index = None
+        self._built_at = 0
+        self._generation = None
+
+    def invalidate(self):
+        self._index = None
+
+    def _get_index(self):
+        index = self._index
+        # Поколение в общем кеше меняется и при загрузке из других
+        # процессов (load_data_json), локальный сброс их не видит.
+        generation = get_generation(INGREDIENTS_GENERATION)
+        expired = monotonic() - self._built_at > INGREDIENT_INDEX_TTL
+        if index is None or expired or generation != self._generation:
+            entries = sorted(
+                (normalize(name), pk, name, measurement_unit)
+                for pk, name, measurement_unit
+                in Ingredient.objects.values_list(
+                    'id', 'name', 'measurement_unit'
+                )
+            )
+            index = ([x[0] for x in entries], entries)
+            self._index = index
+            self._built_at = monotonic()
+            self._generation = generation
+        return index
+
+    def search(self, query, limit=INGREDIENT_SEARCH_LIMIT):
+        keys, entries = self._get_index()
+        query = normalize(query)
+        found = []
+        position = bisect_left(keys, query)
+        while (position < len(keys) and len(found) < limit
+               and keys[position].startswith(query)):
+            found.append(entries[position])
+            position += 1
+        if len(found) < limit:
+            for entry in entries:
+                if query in entry[0] and not entry[0].startswith(query):
+                    found.append(entry)
+                    if len(found) == limit:
+                        break
+        return [{'id': pk, 'name': name, 'measurement_unit': unit}
+                for _, pk, name, unit in found]
+
+
+ingredient_index = IngredientIndex()
@@ -1,44 +1,211 @@
 import base64
+import binascii
+import hashlib
+from io import BytesIO
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files.uploadedfile import (InMemoryUploadedFile,
+                                            TemporaryUploadedFile)
 from django.core.validators import MinValueValidator
+from django.db import transaction
+from django.db.models import Manager
+from PIL import Image
 from rest_framework import serializers
-from rest_framework.validators import UniqueTogetherValidator
 
-from recipes.models import (Favorite,
-                            Ingredient,
+from recipes.images import discard_image_variants, schedule_image_processing
+from recipes.models import (Ingredient,
                             IngredientRecipe,
                             Recipe,
-                            Tag,)
+                            ShoppingListItem,
+                            Tag,
+                            prefetch_for_read)
 from users.models import Subscription
 from users.serializers import CustomUserSerializer
-from .utils import value_to_int
+from users.utils import get_subscribed_ids
+from .cache import RECIPE_BODY_TIMEOUT, recipe_body_keys
+from .utils import get_favorite_ids, get_shopping_cart_ids, value_to_int
 
 User = get_user_model()
 
 MIN_INGREDIENT_AMOUNT = 1
+MAX_BULK_RECIPES = 100
+BASE64_SEPARATOR = ';base64,'
+BASE64_CHUNK_SIZE = 64 * 1024
 
 
 def create_ingredient_recipe_relation(ingredients_data, recipe):
     instances = [IngredientRecipe(
         recipe=recipe,
-        ingredient=x['id'],
+        ingredient_id=x['id'],
         amount=x['amount']
     ) for x in ingredients_data]
     IngredientRecipe.objects.bulk_create(instances)
 
 
+def check_ids_exist(model, ids, message):
+    missing = set(ids) - set(
+        model.objects.filter(id__in=ids).values_list('id', flat=True)
+    )
+    if missing:
+        raise serializers.ValidationError(
+            {'errors': f'{message}: {sorted(missing)}'}
+        )
+
+
+def update_ingredient_recipe_relation(ingredients_data, recipe):
+    current = {x.ingredient_id: x for x in recipe.recipe_ingredients.all()}
+    amounts = {x['id']: x['amount'] for x in ingredients_data}
+    removed = current.keys() - amounts.keys()
+    added = [IngredientRecipe(recipe=recipe,
+                              ingredient_id=ingredient_id,
+                              amount=amount)
+             for ingredient_id, amount in amounts.items()
+             if ingredient_id not in current]
+    changed = []
+    for ingredient_id, amount in amounts.items():
+        item = current.get(ingredient_id)
+        if item is not None and item.amount != amount:
+            item.amount = amount
+            changed.append(item)
+    if not (removed or added or changed):
+        return False
+    ShoppingListItem.objects.apply_cart(-1, recipe_ids=[recipe.id])
+    if removed:
+        IngredientRecipe.objects.filter(
+            recipe=recipe, ingredient_id__in=removed
+        ).delete()
+    IngredientRecipe.objects.bulk_update(changed, ['amount'])
+    IngredientRecipe.objects.bulk_create(added)
+    ShoppingListItem.objects.apply_cart(1, recipe_ids=[recipe.id])
+    return True
+
+
+def update_recipe_tags(tags_data, recipe):
+    current = set(recipe.tags.values_list('id', flat=True))
+    tags = set(tags_data)
+    if current == tags:
+        return False
+    recipe.tags.set(tags)
+    return True
+
+
+def same_image(recipe, upload):
+    field_file = recipe.image
+    if not field_file:
+        return False
+    if recipe.image_hash:
+        digest = hashlib.sha256()
+        for chunk in upload.chunks():
+            digest.update(chunk)
+        upload.seek(0)
+        return digest.hexdigest() == recipe.image_hash
+    try:
+        if field_file.size != upload.size:
+            return False
+        field_file.open('rb')
+        try:
+            return field_file.read() == upload.read()
+        finally:
+            field_file.close()
+            upload.seek(0)
+    except OSError:
+        return False
+
+
+def image_status(recipe):
+    if recipe.image_failed:
+        return 'failed'
+    return 'ready' if recipe.image_variants else 'processing'
+
+
+def image_url(recipe):
+    return recipe.image.url if recipe.image else None
+
+
+def image_variant_urls(recipe):
+    # Ссылки относительные, как и image: тело рецепта кешируется
+    # без запроса и не зависит от хоста.
+    storage = Recipe._meta.get_field('image').storage
+    return {variant: {image_format: storage.url(name)
+                      for image_format, name in formats.items()}
+            for variant, formats in recipe.image_variants.items()}
+
+
 class Base64ImageField(serializers.ImageField):
+    default_error_messages = {
+        'invalid_base64': 'Картинка должна быть закодирована в base64.',
+        'too_large': 'Размер картинки не должен превышать {max_size} МБ.',
+        'too_many_pixels': ('Разрешение картинки не должно превышать '
+                            '{max_pixels} мегапикселей.'),
+    }
+
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
-
+            data = self.decode(data)
+        elif getattr(data, 'size', 0) > settings.RECIPE_IMAGE_MAX_UPLOAD_SIZE:
+            self.fail_too_large()
+        self.check_dimensions(data)
         return super().to_internal_value(data)
 
+    def fail_too_large(self):
+        self.fail('too_large',
+                  max_size=settings.RECIPE_IMAGE_MAX_UPLOAD_SIZE // 2 ** 20)
+
+    def decode(self, data):
+        header_end = data.find(BASE64_SEPARATOR)
+        if header_end == -1:
+            self.fail('invalid_base64')
+        ext = data[:header_end].split('/')[-1]
+        start = header_end + len(BASE64_SEPARATOR)
+        # Размер проверяется по длине строки, до декодирования.
+        decoded_size = (len(data) - start) * 3 // 4
+        if decoded_size > settings.RECIPE_IMAGE_MAX_UPLOAD_SIZE:
+            self.fail_too_large()
+        name = 'temp.' + ext
+        content_type = 'image/' + ext
+        if decoded_size > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+            upload = TemporaryUploadedFile(name, content_type, 0, None)
+        else:
+            upload = InMemoryUploadedFile(BytesIO(), None, name,
+                                          content_type, 0, None)
+        # Переносы строк (MIME, Base64.DEFAULT в Android) отбрасываются,
+        # неполная четвёрка символов переходит в следующий кусок.
+        rest = ''
+        try:
+            for offset in range(start, len(data), BASE64_CHUNK_SIZE):
+                chunk = rest + ''.join(
+                    data[offset:offset + BASE64_CHUNK_SIZE].split()
+                )
+                end = len(chunk) - len(chunk) % 4
+                upload.write(base64.b64decode(chunk[:end], validate=True))
+                rest = chunk[end:]
+            upload.write(base64.b64decode(rest, validate=True))
+        except binascii.Error:
+            upload.close()
+            self.fail('invalid_base64')
+        upload.size = upload.tell()
+        upload.seek(0)
+        return upload
+
+    def check_dimensions(self, upload):
+        if not hasattr(upload, 'seek'):
+            return
+        try:
+            # Pillow читает только заголовок, пиксели не декодируются.
+            with Image.open(upload) as image:
+                width, height = image.size
+        except Image.DecompressionBombError:
+            width = height = settings.RECIPE_IMAGE_MAX_PIXELS
+        except OSError:
+            return
+        finally:
+            upload.seek(0)
+        if width * height >= settings.RECIPE_IMAGE_MAX_PIXELS:
+            self.fail('too_many_pixels',
+                      max_pixels=settings.RECIPE_IMAGE_MAX_PIXELS // 10 ** 6)
+
 
 class TagSerializer(serializers.ModelSerializer):
 
@@ -65,12 +232,21 @@ class IngredientRecipeSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
+class RecipeListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        recipes = data.all() if isinstance(data, Manager) else data
+        return [self.child.personalize(body)
+                for body in self.child.get_bodies(list(recipes))]
+
+
 class RecipeSerializer(serializers.ModelSerializer):
     tags = TagSerializer(many=True, read_only=True)
     ingredients = IngredientRecipeSerializer(many=True,
                                              read_only=True,
                                              source='recipe_ingredients')
     image = serializers.SerializerMethodField('get_image_url', read_only=True)
+    image_variants = serializers.SerializerMethodField(read_only=True)
+    image_status = serializers.SerializerMethodField(read_only=True)
     is_favorited = serializers.SerializerMethodField(read_only=True)
     author = CustomUserSerializer(read_only=True)
     is_in_shopping_cart = serializers.SerializerMethodField(read_only=True)
@@ -86,35 +262,63 @@ class RecipeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Recipe
         fields = ('id', 'tags', 'author', 'ingredients', 'name',
-                  'image', 'text', 'cooking_time', 'is_favorited',
-                  'is_in_shopping_cart')
+                  'image', 'image_variants', 'image_status', 'text',
+                  'cooking_time', 'is_favorited', 'is_in_shopping_cart')
+        list_serializer_class = RecipeListSerializer
+
+    def get_bodies(self, recipes):
+        keys = recipe_body_keys(recipes)
+        cached = cache.get_many(keys)
+        missing = {key: recipe for key, recipe in zip(keys, recipes)
+                   if key not in cached}
+        if missing:
+            prefetch_for_read(list(missing.values()))
+            # Общее тело строится без запроса, чтобы в кеш не попали
+            # поля конкретного пользователя; их добавляет personalize.
+            anonymous = type(self)(context={})
+            bodies = {key: super(RecipeSerializer, anonymous)
+                      .to_representation(recipe)
+                      for key, recipe in missing.items()}
+            cache.set_many(bodies, RECIPE_BODY_TIMEOUT)
+            cached.update(bodies)
+        return [cached[key] for key in keys]
+
+    def personalize(self, body):
+        request = self.context.get('request')
+        data = dict(body)
+        data['is_favorited'] = data['id'] in get_favorite_ids(request)
+        data['is_in_shopping_cart'] = (
+            data['id'] in get_shopping_cart_ids(request)
+        )
+        if data['author'] is not None:
+            data['author'] = dict(
+                data['author'],
+                is_subscribed=(data['author']['id']
+                               in get_subscribed_ids(request))
+            )
+        return data
+
+    def to_representation(self, instance):
+        return self.personalize(self.get_bodies([instance])[0])
 
     def get_image_url(self, obj):
-        if obj.image:
-            return obj.image.url
-        return None
+        return image_url(obj)
+
+    def get_image_variants(self, obj):
+        return image_variant_urls(obj)
+
+    def get_image_status(self, obj):
+        return image_status(obj)
 
     def get_is_favorited(self, obj):
-        if not self.context:
-            return False
-        user = self.context.get('request').user
-        if not user.is_authenticated:
-            return False
-        return user.favorites.filter(recipe=obj).exists()
+        return obj.id in get_favorite_ids(self.context.get('request'))
 
     def get_is_in_shopping_cart(self, obj):
-        if not self.context:
-            return False
-        user = self.context.get('request').user
-        if not user.is_authenticated:
-            return False
-        return user.shopping_cart.filter(recipe=obj).exists()
+        return obj.id in get_shopping_cart_ids(self.context.get('request'))
 
 
 class IngredientRecipePostSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all()
-    )
+    id = serializers.IntegerField()
     amount = serializers.IntegerField(
         validators=(
             MinValueValidator(
@@ -135,6 +339,7 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
         many=True,
         source='recipe_ingredients'
     )
+    tags = serializers.ListField(child=serializers.IntegerField())
     cooking_time = serializers.IntegerField(
         validators=(MinValueValidator(
             limit_value=1,
@@ -167,58 +372,103 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 {'errors': 'нельзя добавить два одинаковых ингредиента'}
             )
-
+        check_ids_exist(Tag, tags, 'Теги не найдены')
+        check_ids_exist(Ingredient, ingredients, 'Ингредиенты не найдены')
         return data
 
+    def save(self, **kwargs):
+        try:
+            return super().save(**kwargs)
+        finally:
+            # Временный файл картинки закрываем сразу после сохранения,
+            # а не когда до него доберётся сборщик мусора.
+            image = self.validated_data.get('image')
+            if image is not None:
+                image.close()
+
     def create(self, validated_data):
         user = self.context.get('request').user
         ingredients_data = validated_data.pop('recipe_ingredients')
         tags_data = validated_data.pop('tags')
-        recipe = Recipe.objects.create(author=user, **validated_data)
-        recipe.tags.set(tags_data)
-        create_ingredient_recipe_relation(ingredients_data, recipe)
+        with transaction.atomic():
+            recipe = Recipe.objects.create(author=user, **validated_data)
+            recipe.tags.set(tags_data)
+            create_ingredient_recipe_relation(ingredients_data, recipe)
+            schedule_image_processing(recipe)
         return recipe
 
     def update(self, instance, validated_data):
         ingredients_data = validated_data.pop('recipe_ingredients')
-        IngredientRecipe.objects.filter(recipe=instance).delete()
-
         tags_data = validated_data.pop('tags')
-        instance.tags.set(tags_data)
-
-        instance.image = validated_data.get('image', instance.image)
-        instance.name = validated_data.get('name', instance.name)
-        instance.text = validated_data.get('text', instance.text)
-        instance.cooking_time = validated_data.get('cooking_time',
-                                                   instance.cooking_time)
-        create_ingredient_recipe_relation(ingredients_data, instance)
-        instance.save()
+        image = validated_data.pop('image', None)
+        changed_fields = [
+            name for name, value in validated_data.items()
+            if getattr(instance, name) != value
+        ]
+        for name in changed_fields:
+            setattr(instance, name, validated_data[name])
+        if image is not None and not same_image(instance, image):
+            discard_image_variants(instance)
+            instance.image = image
+            changed_fields += ['image', 'image_hash', 'image_variants',
+                               'image_failed']
+        with transaction.atomic():
+            # Блокируем только строку рецепта, чтобы параллельные
+            # автосохранения не построили дифф по одним и тем же строкам.
+            Recipe.objects.select_for_update().only('pk').get(pk=instance.pk)
+            ingredients_changed = update_ingredient_recipe_relation(
+                ingredients_data, instance
+            )
+            tags_changed = update_recipe_tags(tags_data, instance)
+            if changed_fields or ingredients_changed or tags_changed:
+                instance.save(update_fields=changed_fields + ['updated_at'])
+            if 'image' in changed_fields:
+                schedule_image_processing(instance)
         return instance
 
     def to_representation(self, instance):
-        return RecipeSerializer(instance).data
+        instance = Recipe.objects.for_read().get(pk=instance.pk)
+        return RecipeSerializer(instance, context=self.context).data
 
 
 class ReceipSmallSerializer(serializers.ModelSerializer):
+    image = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_status = serializers.SerializerMethodField()
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'image_status',
+                  'cooking_time')
 
+    def get_image(self, obj):
+        return image_url(obj)
 
-class FavoriteSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Favorite
-        fields = '__all__'
-        validators = [
-            UniqueTogetherValidator(
-                queryset=Favorite.objects.all(),
-                fields=('user', 'recipe'),
-                message='Рецепт уже добавлен в избранное'
-            )
-        ]
+    def get_image_variants(self, obj):
+        return image_variant_urls(obj)
 
-    def to_representation(self, instance):
-        return ReceipSmallSerializer(instance.recipe).data
+    def get_image_status(self, obj):
+        return image_status(obj)
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=MAX_BULK_RECIPES
+    )
+
+    def validate_recipes(self, value):
+        recipes = list(Recipe.objects.filter(id__in=value).only(
+            'id', 'name', 'image', 'image_variants', 'image_failed',
+            'cooking_time'
+        ))
+        missing = set(value) - {recipe.id for recipe in recipes}
+        if missing:
+            raise serializers.ValidationError(
+                f'Рецепты не найдены: {sorted(missing)}'
+            )
+        return recipes
 
 
 class SubscribeSerializer(serializers.ModelSerializer):
@@ -259,6 +509,8 @@ class SubscribeReprSerializer(CustomUserSerializer):
                             'recipes', 'recipes_count')
 
     def get_recipes(self, obj):
+        if hasattr(obj, 'recipes_preview'):
+            return ReceipSmallSerializer(obj.recipes_preview, many=True).data
         request = self.context.get('request')
         limit = value_to_int(request.query_params.get('recipes_limit'))
         recipes = obj.recipes.all()
@@ -267,4 +519,6 @@ class SubscribeReprSerializer(CustomUserSerializer):
         return ReceipSmallSerializer(recipes, many=True).data
 
     def get_recipes_count(self, obj):
+        if hasattr(obj, 'recipes_count'):
+            return obj.recipes_count
         return obj.recipes.count()
@@ -0,0 +1,114 @@
+import csv
+from functools import lru_cache
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.db.models import Case, CharField, F, IntegerField, Sum, Value, When
+
+from recipes.models import ShoppingListItem
+
+ITERATOR_CHUNK_SIZE = 500
+PDF_SPOOL_SIZE = 1024 * 1024
+CSV_HEADER = ('Ингредиент', 'Единица измерения', 'Количество')
+PDF_FONT_NAME = 'ShoppingListFont'
+
+# Единица измерения -> (каноническая единица, множитель).
+# Единицы, которых нет в таблице, суммируются как есть.
+UNIT_CONVERSIONS = {
+    'г': ('г', 1),
+    'кг': ('г', 1000),
+    'мл': ('мл', 1),
+    'л': ('мл', 1000),
+    'ч. л.': ('ч. л.', 1),
+    'дес. л.': ('ч. л.', 2),
+    'ст. л.': ('ч. л.', 3),
+}
+
+
+def unit_case(index, default, output_field):
+    return Case(
+        *(When(ingredient__measurement_unit=unit,
+               then=Value(conversion[index]))
+          for unit, conversion in UNIT_CONVERSIONS.items()),
+        default=default,
+        output_field=output_field
+    )
+
+
+def get_shopping_list(user):
+    return ShoppingListItem.objects.filter(
+        user=user
+    ).annotate(
+        unit=unit_case(0, F('ingredient__measurement_unit'), CharField()),
+        factor=unit_case(1, Value(1), IntegerField()),
+    ).values(
+        'ingredient__name', 'unit'
+    ).annotate(
+        total=Sum(F('amount') * F('factor'))
+    ).order_by(
+        'ingredient__name', 'unit'
+    ).values_list(
+        'ingredient__name', 'unit', 'total'
+    ).iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+
+
+def render_txt(rows):
+    for row in rows:
+        yield ' - '.join(map(str, row)) + '\n'
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def render_csv(rows):
+    writer = csv.writer(Echo())
+    yield '\ufeff' + writer.writerow(CSV_HEADER)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+@lru_cache(maxsize=None)
+def register_pdf_font():
+    """Загружает шрифт один раз на процесс, а не на каждый запрос."""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    pdfmetrics.registerFont(
+        TTFont(PDF_FONT_NAME, settings.SHOPPING_LIST_PDF_FONT)
+    )
+    return PDF_FONT_NAME
+
+
+def render_pdf(rows):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen.canvas import Canvas
+
+    font = register_pdf_font()
+    output = SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    canvas = Canvas(output, pagesize=A4)
+    width, height = A4
+    margin, line_height = 50, 18
+    y = height - margin
+    canvas.setFont(font, 16)
+    canvas.drawString(margin, y, 'Список покупок')
+    y -= line_height * 2
+    canvas.setFont(font, 12)
+    for name, unit, amount in rows:
+        if y < margin:
+            canvas.showPage()
+            canvas.setFont(font, 12)
+            y = height - margin
+        canvas.drawString(margin, y, f'• {name} ({unit}) — {amount}')
+        y -= line_height
+    canvas.save()
+    output.seek(0)
+    return output
+
+
+EXPORT_FORMATS = {
+    'txt': (render_txt, 'text/plain; charset=utf-8'),
+    'csv': (render_csv, 'text/csv; charset=utf-8'),
+    'pdf': (render_pdf, 'application/pdf'),
+}
@@ -0,0 +1,120 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+
+from recipes.models import (Favorite,
+                            Ingredient,
+                            IngredientRecipe,
+                            Recipe,
+                            ShoppingCart,
+                            ShoppingListItem,
+                            Tag)
+from recipes.signals import objects_loaded, user_recipes_changed
+from users.models import Subscription
+from .cache import (CATALOG_GENERATION, INGREDIENTS_GENERATION,
+                    RECIPES_GENERATION, RESPONSES_GENERATION,
+                    TAGS_GENERATION, author_generation_name,
+                    bump_generation, user_generation_name)
+from .filters import tag_slug_map
+from .search import ingredient_index
+
+User = get_user_model()
+
+
+def only_last_login(update_fields):
+    return update_fields is not None and set(update_fields) == {'last_login'}
+
+
+@receiver([post_save, post_delete, objects_loaded], sender=Ingredient)
+def reset_ingredient_index(**kwargs):
+    ingredient_index.invalidate()
+    bump_generation(INGREDIENTS_GENERATION)
+
+
+@receiver([post_save, post_delete, objects_loaded], sender=Tag)
+def reset_tag_slug_map(**kwargs):
+    tag_slug_map.invalidate()
+    bump_generation(TAGS_GENERATION)
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+# Связи с удалённым тегом удаляются без m2m_changed, а смена slug меняет
+# выборку по ?tags=, поэтому счётчики сбрасываются и по изменениям тегов.
+@receiver([post_save, post_delete, objects_loaded], sender=Tag)
+def bump_recipes_generation(**kwargs):
+    bump_generation(RECIPES_GENERATION)
+    bump_generation(RESPONSES_GENERATION)
+
+
+@receiver([post_save, post_delete], sender=Favorite)
+@receiver([post_save, post_delete], sender=ShoppingCart)
+def refresh_recipe_counter(sender, instance, created=None, **kwargs):
+    # Менеджер сам обновляет счётчики сырым SQL без сигналов, а сюда
+    # попадают изменения в обход него: ORM, каскад при удалении, админка.
+    if created is False:
+        return
+    sender.objects.refresh_counters([instance.recipe_id])
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_shopping_list(instance, created, **kwargs):
+    if created:
+        ShoppingListItem.objects.apply_cart(1, instance.user_id,
+                                            [instance.recipe_id])
+
+
+# Срабатывает и при каскадном удалении рецепта: пока строки корзины
+# и состав рецепта ещё на месте, их вклад вычитается из списков.
+@receiver(pre_delete, sender=ShoppingCart)
+def remove_from_shopping_list(instance, **kwargs):
+    ShoppingListItem.objects.apply_cart(-1, instance.user_id,
+                                        [instance.recipe_id])
+
+
+@receiver([post_save, post_delete], sender=IngredientRecipe)
+@receiver([post_save, post_delete, objects_loaded], sender=Tag)
+@receiver([post_save, post_delete, objects_loaded], sender=Ingredient)
+@receiver([post_save, post_delete], sender=Favorite)
+def bump_responses_generation(**kwargs):
+    bump_generation(RESPONSES_GENERATION)
+
+
+@receiver([post_save, post_delete], sender=User)
+def bump_author_responses_generation(signal, instance, update_fields=None,
+                                     **kwargs):
+    if only_last_login(update_fields):
+        return
+    # Анонимные ответы содержат только авторов рецептов. При удалении
+    # автора рецепты к этому моменту уже отвязаны от него.
+    if (signal is post_delete
+            or Recipe.objects.filter(author_id=instance.id).exists()):
+        bump_generation(RESPONSES_GENERATION)
+
+
+@receiver([post_save, post_delete], sender=Favorite)
+@receiver([post_save, post_delete], sender=ShoppingCart)
+@receiver([post_save, post_delete], sender=Subscription)
+def bump_user_generation(instance, **kwargs):
+    bump_generation(user_generation_name(instance.user_id))
+
+
+@receiver(user_recipes_changed)
+def bump_user_recipes_generations(sender, user, **kwargs):
+    bump_generation(user_generation_name(user.id))
+    if sender is Favorite:
+        bump_generation(RESPONSES_GENERATION)
+
+
+@receiver([post_save, post_delete, objects_loaded], sender=Tag)
+@receiver([post_save, post_delete, objects_loaded], sender=Ingredient)
+def bump_catalog_generation(**kwargs):
+    bump_generation(CATALOG_GENERATION)
+
+
+@receiver([post_save, post_delete], sender=User)
+def bump_author_generation(instance, update_fields=None, **kwargs):
+    if only_last_login(update_fields):
+        return
+    bump_generation(author_generation_name(instance.id))
@@ -0,0 +1,565 @@
+import base64
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Sum
+from django.test import Client, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework import serializers, status
+from rest_framework.test import APIClient
+
+from recipes.models import (Favorite, Ingredient, IngredientRecipe, Recipe,
+                            ShoppingCart, Tag)
+from .cache import recipe_body_keys
+from .serializers import MAX_BULK_RECIPES, Base64ImageField
+from .shopping_list import register_pdf_font
+
+User = get_user_model()
+
+MEDIA_ROOT = tempfile.mkdtemp()
+# Запись рецепта не должна зависеть от числа ингредиентов.
+# Бюджет включает SAVEPOINT и RELEASE вокруг transaction.atomic.
+CREATE_QUERY_BUDGET = 16
+UPDATE_QUERY_BUDGET = 20
+
+
+def image_bytes():
+    output = BytesIO()
+    Image.new('RGB', (20, 20), 'red').save(output, 'PNG')
+    return output.getvalue()
+
+
+def image_data():
+    return 'data:image/png;base64,' + base64.b64encode(image_bytes()).decode()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, IMAGE_PROCESSING_SYNC=False)
+class RecipeWriteQueryBudgetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='author@example.org', username='author',
+            first_name='Иван', last_name='Иванов', password='password'
+        )
+        Tag.objects.bulk_create(
+            Tag(name=f'Тег {i}', color=f'#00000{i}', slug=f'tag{i}')
+            for i in range(3)
+        )
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'Ингредиент {i}', measurement_unit='г')
+            for i in range(30)
+        )
+        cls.tags = list(Tag.objects.all())
+        cls.ingredients = list(Ingredient.objects.all())
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def payload(self, count, amount=10):
+        return {
+            'ingredients': [{'id': ingredient.id, 'amount': amount}
+                            for ingredient in self.ingredients[:count]],
+            'tags': [tag.id for tag in self.tags],
+            'image': image_data(),
+            'name': f'Рецепт из {count}',
+            'text': 'Описание',
+            'cooking_time': 10,
+        }
+
+    def test_create_query_budget(self):
+        for count in (1, 30):
+            with self.subTest(ingredients=count):
+                with self.assertNumQueries(CREATE_QUERY_BUDGET):
+                    response = self.client.post(
+                        '/api/recipes/', self.payload(count), format='json'
+                    )
+                self.assertEqual(response.status_code,
+                                 status.HTTP_201_CREATED)
+                self.assertEqual(len(response.data['ingredients']), count)
+
+    def test_update_query_budget(self):
+        for count in (1, 30):
+            with self.subTest(ingredients=count):
+                response = self.client.post(
+                    '/api/recipes/', self.payload(count), format='json'
+                )
+                recipe_id = response.data['id']
+                payload = self.payload(count, amount=20)
+                del payload['image']
+                with self.assertNumQueries(UPDATE_QUERY_BUDGET):
+                    response = self.client.patch(
+                        f'/api/recipes/{recipe_id}/', payload, format='json'
+                    )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(
+                    list(Recipe.objects.get(pk=recipe_id).recipe_ingredients
+                         .values_list('amount', flat=True).distinct()),
+                    [20]
+                )
+
+
+class Base64ImageFieldTest(TestCase):
+    def test_line_wrapped_base64(self):
+        raw = image_bytes()
+        wrapped = base64.encodebytes(raw).decode()
+        for encoded in (wrapped, wrapped.replace('\n', '\r\n')):
+            with self.subTest(encoded=encoded[:20]):
+                upload = Base64ImageField().decode(
+                    'data:image/png;base64,' + encoded
+                )
+                self.assertEqual(upload.read(), raw)
+
+    def test_truncated_base64(self):
+        encoded = base64.b64encode(image_bytes()).decode()[:-1]
+        with self.assertRaises(serializers.ValidationError):
+            Base64ImageField().decode('data:image/png;base64,' + encoded)
+
+
+class RecipeAPITestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.org', username='author',
+            first_name='Иван', last_name='Иванов', password='password'
+        )
+        cls.user = User.objects.create_user(
+            email='user@example.org', username='user',
+            first_name='Пётр', last_name='Петров', password='password'
+        )
+        cls.tag = Tag.objects.create(name='Завтрак', color='#E26C2D',
+                                     slug='breakfast')
+        cls.ingredient = Ingredient.objects.create(name='Сахар',
+                                                   measurement_unit='г')
+
+    def setUp(self):
+        # Поколения и счётчики в кеше переживают откат транзакции теста.
+        cache.clear()
+        self.anonymous = APIClient()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_recipe(self, name='Рецепт', tags=(), ingredients=(),
+                      **kwargs):
+        recipe = Recipe.objects.create(
+            author=self.author, name=name, text='Описание',
+            cooking_time=10, image='recipes/images/recipe.png', **kwargs
+        )
+        recipe.tags.set(tags)
+        for ingredient, amount in ingredients:
+            recipe.recipe_ingredients.create(ingredient=ingredient,
+                                             amount=amount)
+        return recipe
+
+
+class RecipeCursorPaginationTest(RecipeAPITestCase):
+    def test_cursor_pages_past_equal_pub_dates(self):
+        recipes = [self.create_recipe(f'Рецепт {i}') for i in range(5)]
+        Recipe.objects.update(pub_date=timezone.now())
+        ids = []
+        url = '/api/recipes/?cursor=&limit=2'
+        while url:
+            response = self.anonymous.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(recipe['id'] for recipe in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(ids, sorted((x.id for x in recipes), reverse=True))
+
+    def test_malformed_cursor(self):
+        for cursor in ('garbage', base64.b64encode(b'no-separator').decode()):
+            with self.subTest(cursor=cursor):
+                response = self.anonymous.get(f'/api/recipes/?cursor={cursor}')
+                self.assertEqual(response.status_code,
+                                 status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_with_other_ordering(self):
+        for params in ('ordering=popular', 'search=суп'):
+            with self.subTest(params=params):
+                response = self.anonymous.get(
+                    f'/api/recipes/?cursor=&{params}'
+                )
+                self.assertEqual(response.status_code,
+                                 status.HTTP_400_BAD_REQUEST)
+                self.assertIn('cursor', response.data)
+
+
+class CachedCountTest(RecipeAPITestCase):
+    def count(self, query=''):
+        response = self.client.get(f'/api/recipes/?{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['count']
+
+    def test_filtered_count_follows_changes(self):
+        self.create_recipe('Без тега')
+        recipe = self.create_recipe('С тегом', tags=[self.tag])
+        self.assertEqual(self.count('tags=breakfast'), 1)
+        self.create_recipe('Ещё с тегом', tags=[self.tag])
+        self.assertEqual(self.count('tags=breakfast'), 2)
+        recipe.delete()
+        self.assertEqual(self.count('tags=breakfast'), 1)
+        self.assertEqual(self.count(), 2)
+
+        self.tag.slug = 'morning'
+        self.tag.save()
+        self.assertEqual(self.count('tags=breakfast'), 0)
+        self.assertEqual(self.count('tags=morning'), 1)
+
+        self.create_recipe('Снова с тегом', tags=[self.tag])
+        self.assertEqual(self.count('tags=morning'), 2)
+        self.tag.delete()
+        self.assertEqual(self.count('tags=morning'), 0)
+        self.assertEqual(self.count(), 3)
+
+
+class AnonymousRecipeCacheTest(RecipeAPITestCase):
+    def test_cached_detail_without_queries(self):
+        recipe = self.create_recipe()
+        url = f'/api/recipes/{recipe.id}/'
+        response = self.anonymous.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.anonymous.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['ETag'], etag)
+            response = self.anonymous.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+
+        recipe.name = 'Новое название'
+        recipe.save()
+        response = self.anonymous.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['name'], 'Новое название')
+
+    def test_authenticated_detail_not_modified(self):
+        recipe = self.create_recipe()
+        url = f'/api/recipes/{recipe.id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class RecipeBodyCacheTest(RecipeAPITestCase):
+    def test_shared_body_has_no_personal_fields(self):
+        recipe = self.create_recipe()
+        Favorite.objects.add(self.user, recipe.id)
+        self.user.follower.create(author=self.author)
+        response = self.client.get(f'/api/recipes/{recipe.id}/')
+        self.assertTrue(response.data['is_favorited'])
+        self.assertTrue(response.data['author']['is_subscribed'])
+        body = cache.get(recipe_body_keys([recipe])[0])
+        self.assertFalse(body['is_favorited'])
+        self.assertFalse(body['author']['is_subscribed'])
+
+
+class ConditionalGetTest(RecipeAPITestCase):
+    def assertNotModified(self, client, url):
+        response = client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        return etag
+
+    def test_not_modified(self):
+        recipe = self.create_recipe()
+        urls = ('/api/tags/', f'/api/tags/{self.tag.id}/',
+                '/api/ingredients/', f'/api/ingredients/{self.ingredient.id}/',
+                f'/api/recipes/{recipe.id}/')
+        for url in urls:
+            for client in (self.anonymous, self.client):
+                with self.subTest(url=url, client=client is self.client):
+                    self.assertNotModified(client, url)
+
+    def test_catalog_etag_changes(self):
+        tags_etag = self.assertNotModified(self.anonymous, '/api/tags/')
+        ingredients_etag = self.assertNotModified(self.anonymous,
+                                                  '/api/ingredients/')
+        Tag.objects.create(name='Обед', color='#49B64E', slug='lunch')
+        Ingredient.objects.create(name='Соль', measurement_unit='г')
+        self.assertNotEqual(self.anonymous.get('/api/tags/')['ETag'],
+                            tags_etag)
+        self.assertNotEqual(self.anonymous.get('/api/ingredients/')['ETag'],
+                            ingredients_etag)
+
+    def test_recipe_etag_changes_after_edit(self):
+        recipe = self.create_recipe()
+        url = f'/api/recipes/{recipe.id}/'
+        etags = {client: self.assertNotModified(client, url)
+                 for client in (self.anonymous, self.client)}
+        recipe.text = 'Новое описание'
+        recipe.save()
+        for client, etag in etags.items():
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['text'], 'Новое описание')
+
+    def test_recipe_etag_changes_after_favorite(self):
+        recipe = self.create_recipe()
+        url = f'/api/recipes/{recipe.id}/'
+        for method, is_favorited in (('post', True), ('delete', False)):
+            with self.subTest(method=method):
+                etag = self.assertNotModified(self.client, url)
+                response = getattr(self.client, method)(f'{url}favorite/')
+                self.assertIn(response.status_code,
+                              (status.HTTP_201_CREATED,
+                               status.HTTP_204_NO_CONTENT))
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['is_favorited'], is_favorited)
+
+
+class UserRecipeTestCase(RecipeAPITestCase):
+    endpoints = (('favorite', Favorite, 'favorites_count'),
+                 ('shopping_cart', ShoppingCart, 'shopping_cart_count'))
+
+    def counter(self, recipe, field):
+        recipe.refresh_from_db(fields=[field])
+        return getattr(recipe, field)
+
+
+class UserRecipeToggleTest(UserRecipeTestCase):
+    def test_double_add_and_remove(self):
+        recipe = self.create_recipe()
+        url = f'/api/recipes/{recipe.id}/'
+        for endpoint, model, field in self.endpoints:
+            with self.subTest(endpoint=endpoint):
+                for expected in (status.HTTP_201_CREATED,
+                                 status.HTTP_400_BAD_REQUEST):
+                    response = self.client.post(f'{url}{endpoint}/')
+                    self.assertEqual(response.status_code, expected)
+                    self.assertEqual(self.counter(recipe, field), 1)
+                for expected in (status.HTTP_204_NO_CONTENT,
+                                 status.HTTP_400_BAD_REQUEST):
+                    response = self.client.delete(f'{url}{endpoint}/')
+                    self.assertEqual(response.status_code, expected)
+                    self.assertEqual(self.counter(recipe, field), 0)
+                self.assertFalse(model.objects.exists())
+
+    def test_missing_recipe(self):
+        for endpoint, _, _ in self.endpoints:
+            for method in ('post', 'delete'):
+                with self.subTest(endpoint=endpoint, method=method):
+                    response = getattr(self.client, method)(
+                        f'/api/recipes/999/{endpoint}/'
+                    )
+                    self.assertEqual(response.status_code,
+                                     status.HTTP_404_NOT_FOUND)
+
+
+class UserRecipeBulkTest(UserRecipeTestCase):
+    def test_bulk_add_with_present_recipes(self):
+        first, second = self.create_recipe(), self.create_recipe()
+        for endpoint, model, field in self.endpoints:
+            with self.subTest(endpoint=endpoint):
+                model.objects.add(self.user, first.id)
+                response = self.client.post(
+                    f'/api/recipes/{endpoint}/',
+                    {'recipes': [first.id, second.id]}, format='json'
+                )
+                self.assertEqual(response.status_code,
+                                 status.HTTP_201_CREATED)
+                self.assertEqual(len(response.data), 2)
+                self.assertEqual(self.counter(first, field), 1)
+                self.assertEqual(self.counter(second, field), 1)
+                self.assertEqual(model.objects.count(), 2)
+
+                response = self.client.delete(
+                    f'/api/recipes/{endpoint}/',
+                    {'recipes': [first.id, second.id]}, format='json'
+                )
+                self.assertEqual(response.status_code,
+                                 status.HTTP_204_NO_CONTENT)
+                self.assertEqual(self.counter(first, field), 0)
+                self.assertEqual(self.counter(second, field), 0)
+
+    def test_bulk_invalid_input(self):
+        recipe = self.create_recipe()
+        too_many = list(range(1, MAX_BULK_RECIPES + 2))
+        for endpoint, model, field in self.endpoints:
+            for recipes in ([recipe.id, 999], too_many, []):
+                with self.subTest(endpoint=endpoint, count=len(recipes)):
+                    response = self.client.post(
+                        f'/api/recipes/{endpoint}/', {'recipes': recipes},
+                        format='json'
+                    )
+                    self.assertEqual(response.status_code,
+                                     status.HTTP_400_BAD_REQUEST)
+                    self.assertIn('recipes', response.data)
+                    self.assertFalse(model.objects.exists())
+                    self.assertEqual(self.counter(recipe, field), 0)
+
+
+class ShoppingListDownloadTest(RecipeAPITestCase):
+    url = '/api/recipes/download_shopping_cart/'
+
+    def setUp(self):
+        super().setUp()
+        kilograms = Ingredient.objects.create(name='Сахар',
+                                              measurement_unit='кг')
+        for ingredient, amount in ((self.ingredient, 100), (kilograms, 1)):
+            recipe = self.create_recipe(ingredients=[(ingredient, amount)])
+            ShoppingCart.objects.add(self.user, recipe.id)
+
+    def download(self, file_format):
+        response = self.client.get(self.url, {'type': file_format})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(f'shopping_cart.{file_format}',
+                      response['Content-Disposition'])
+        return b''.join(response.streaming_content)
+
+    def test_txt(self):
+        self.assertEqual(self.download('txt').decode(), 'Сахар - г - 1100\n')
+
+    def test_csv(self):
+        self.assertEqual(
+            self.download('csv').decode(),
+            '\ufeffИнгредиент,Единица измерения,Количество\r\n'
+            'Сахар,г,1100\r\n'
+        )
+
+    def test_pdf_registers_font_once(self):
+        from reportlab.pdfbase import ttfonts
+
+        register_pdf_font.cache_clear()
+        with mock.patch.object(ttfonts, 'TTFont',
+                               wraps=ttfonts.TTFont) as load_font:
+            for _ in range(2):
+                self.assertTrue(self.download('pdf').startswith(b'%PDF'))
+        self.assertEqual(load_font.call_count, 1)
+
+    def test_unknown_format(self):
+        response = self.client.get(self.url, {'type': 'docx'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ShoppingListConsistencyTest(RecipeAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author_client = APIClient()
+        self.author_client.force_authenticate(self.author)
+        salt = Ingredient.objects.create(name='Соль', measurement_unit='г')
+        self.first = self.create_recipe(
+            ingredients=[(self.ingredient, 100), (salt, 5)]
+        )
+        self.second = self.create_recipe(ingredients=[(self.ingredient, 50)])
+        self.third = self.create_recipe(ingredients=[(salt, 7)])
+
+    def assertListMatchesCarts(self):
+        expected = ''.join(
+            f'{name} - {unit} - {total}\n'
+            for name, unit, total in IngredientRecipe.objects.filter(
+                recipe__shopping_cart__user=self.user
+            ).values_list(
+                'ingredient__name', 'ingredient__measurement_unit'
+            ).annotate(total=Sum('amount')).order_by('ingredient__name')
+        )
+        response = self.client.get('/api/recipes/download_shopping_cart/')
+        self.assertEqual(b''.join(response.streaming_content).decode(),
+                         expected)
+
+    def test_list_follows_cart_changes(self):
+        first, second, third = self.first, self.second, self.third
+        self.client.post(f'/api/recipes/{first.id}/shopping_cart/')
+        self.client.post(f'/api/recipes/{second.id}/shopping_cart/')
+        self.assertListMatchesCarts()
+
+        self.client.post('/api/recipes/shopping_cart/',
+                         {'recipes': [first.id, third.id]}, format='json')
+        self.assertListMatchesCarts()
+
+        response = self.author_client.patch(
+            f'/api/recipes/{first.id}/',
+            {'ingredients': [{'id': self.ingredient.id, 'amount': 30}],
+             'tags': [self.tag.id]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListMatchesCarts()
+
+        self.client.delete(f'/api/recipes/{second.id}/shopping_cart/')
+        self.assertListMatchesCarts()
+
+        self.client.delete('/api/recipes/shopping_cart/',
+                           {'recipes': [first.id]}, format='json')
+        self.assertListMatchesCarts()
+
+    def test_list_follows_orm_changes(self):
+        ShoppingCart.objects.create(user=self.user, recipe=self.first)
+        cart = ShoppingCart.objects.create(user=self.user, recipe=self.second)
+        self.assertListMatchesCarts()
+        self.first.refresh_from_db(fields=['shopping_cart_count'])
+        self.assertEqual(self.first.shopping_cart_count, 1)
+        cart.delete()
+        self.assertListMatchesCarts()
+        self.first.delete()
+        self.assertListMatchesCarts()
+
+    def test_list_follows_admin_inline(self):
+        ShoppingCart.objects.add(self.user, self.first.id)
+        admin_client = Client()
+        admin_client.force_login(User.objects.create_superuser(
+            email='admin@example.org', username='admin', password='password',
+            first_name='Админ', last_name='Админов'
+        ))
+        items = list(self.first.recipe_ingredients.order_by('id'))
+        data = {
+            'name': self.first.name, 'text': self.first.text,
+            'author': self.author.id, 'tags': [self.tag.id],
+            'cooking_time': self.first.cooking_time,
+            'recipe_ingredients-TOTAL_FORMS': len(items),
+            'recipe_ingredients-INITIAL_FORMS': len(items),
+            'recipe_ingredients-MIN_NUM_FORMS': 0,
+            'recipe_ingredients-MAX_NUM_FORMS': 1000,
+        }
+        for index, item in enumerate(items):
+            data.update({
+                f'recipe_ingredients-{index}-id': item.id,
+                f'recipe_ingredients-{index}-recipe': self.first.id,
+                f'recipe_ingredients-{index}-ingredient': item.ingredient_id,
+                f'recipe_ingredients-{index}-amount': item.amount * 3,
+            })
+        data['recipe_ingredients-1-DELETE'] = 'on'
+        response = admin_client.post(
+            f'/admin/recipes/recipe/{self.first.id}/change/', data
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.first.recipe_ingredients.get().amount, 300)
+        self.assertListMatchesCarts()
+
+
+class ImageUrlTest(UserRecipeTestCase):
+    def test_same_relative_urls_everywhere(self):
+        recipe = self.create_recipe(image_variants={
+            'thumbnail': {'webp': 'recipes/images/variants/recipe.webp'}
+        })
+        self.user.follower.create(author=self.author)
+        detail = self.client.get(f'/api/recipes/{recipe.id}/').data
+        small = [
+            self.client.post(f'/api/recipes/{recipe.id}/favorite/').data,
+            self.client.post('/api/recipes/shopping_cart/',
+                             {'recipes': [recipe.id]}, format='json').data[0],
+            self.client.get(
+                '/api/users/subscriptions/'
+            ).data['results'][0]['recipes'][0],
+        ]
+        self.assertTrue(detail['image'].startswith('/media/'))
+        self.assertEqual(
+            detail['image_variants'],
+            {'thumbnail': {'webp': '/media/recipes/images/variants/'
+                                   'recipe.webp'}}
+        )
+        for data in small:
+            self.assertEqual(data['image'], detail['image'])
+            self.assertEqual(data['image_variants'], detail['image_variants'])
@@ -3,3 +3,24 @@ def value_to_int(value):
         return int(value)
     except: # noqa
         return None
+
+
+def get_recipe_ids(request, related_name):
+    if request is None or not request.user.is_authenticated:
+        return frozenset()
+    attr = f'_{related_name}_ids'
+    if not hasattr(request, attr):
+        setattr(request, attr, set(
+            getattr(request.user, related_name).values_list(
+                'recipe_id', flat=True
+            )
+        ))
+    return getattr(request, attr)
+
+
+def get_favorite_ids(request):
+    return get_recipe_ids(request, 'favorites')
+
+
+def get_shopping_cart_ids(request):
+    return get_recipe_ids(request, 'shopping_cart')
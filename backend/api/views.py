@@ -1,29 +1,42 @@
+from collections import defaultdict
+
 from django.contrib.auth import get_user_model
-from django.db.models import Sum
-from django.shortcuts import HttpResponse, get_object_or_404
+from django.db.models import Count
+from django.http import FileResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import etag
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .cache import (INGREDIENTS_GENERATION, TAGS_GENERATION,
+                    cache_anonymous_response, generation_etag, recipe_etag)
 from .filters import RecipeFilter
+from .paginators import RecipePagination
 from .permissions import AuthorOrReadOnly
-from .serializers import (FavoriteSerializer,
-                          IngredientSerializer,
+from .search import ingredient_index
+from .shopping_list import EXPORT_FORMATS, get_shopping_list
+from .serializers import (IngredientSerializer,
                           TagSerializer,
                           RecipeSerializer,
                           ReceipSmallSerializer,
                           RecipeCreateSerializer,
+                          RecipeIdsSerializer,
                           SubscribeSerializer,
                           SubscribeReprSerializer)
-from recipes.models import (Ingredient,
-                            IngredientRecipe,
+from recipes.models import (Favorite,
+                            Ingredient,
                             Recipe,
+                            ShoppingCart,
                             Tag)
 from users.models import Subscription
-from .errors import (RECIPE_FAVORITE_ERROR, SHOPPING_CART_ALLREADY_IN_ERROR,
+from .errors import (RECIPE_FAVORITE_ALLREADY_IN_ERROR, RECIPE_FAVORITE_ERROR,
+                     SHOPPING_CART_ALLREADY_IN_ERROR,
                      SHOPPING_CART_NOT_IN_ERROR, SUBSCRIBE_ERROR)
+from .utils import value_to_int
 
 User = get_user_model()
 
@@ -56,9 +69,27 @@ class SubscriptionsViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        return User.objects.filter(following__user=self.request.user)
-
-
+        return User.objects.filter(
+            following__user=self.request.user
+        ).annotate(
+            recipes_count=Count('recipes', distinct=True)
+        ).order_by('id')
+
+    def paginate_queryset(self, queryset):
+        authors = super().paginate_queryset(queryset)
+        if authors is None:
+            return None
+        limit = value_to_int(self.request.query_params.get('recipes_limit'))
+        recipes = defaultdict(list)
+        for recipe in Recipe.objects.latest_by_author(authors, limit):
+            recipes[recipe.author_id].append(recipe)
+        for author in authors:
+            author.recipes_preview = recipes[author.id]
+        return authors
+
+
+@method_decorator(etag(generation_etag(TAGS_GENERATION)), name='list')
+@method_decorator(etag(generation_etag(TAGS_GENERATION)), name='retrieve')
 class TagViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = TagSerializer
     permission_classes = (permissions.AllowAny,)
@@ -67,90 +98,131 @@ class TagViewSet(viewsets.ReadOnlyModelViewSet):
     http_method_names = ('get',)
 
 
+@method_decorator(etag(generation_etag(INGREDIENTS_GENERATION)),
+                  name='list')
+@method_decorator(etag(generation_etag(INGREDIENTS_GENERATION)),
+                  name='retrieve')
 class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = IngredientSerializer
     permission_classes = (permissions.AllowAny,)
     pagination_class = None
-    filter_backends = (DjangoFilterBackend,)
-    filterset_fields = ('name',)
     queryset = Ingredient.objects.all()
     http_method_names = ('get',)
 
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if name:
+            return Response(ingredient_index.search(name))
+        return super().list(request, *args, **kwargs)
+
 
 class RecipeViewSet(viewsets.ModelViewSet):
-    queryset = Recipe.objects.prefetch_related('tags',
-                                               'ingredients',
-                                               'author')
+    lookup_value_regex = r'\d+'
     permission_classes = (AuthorOrReadOnly,)
+    pagination_class = RecipePagination
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
 
+    def get_queryset(self):
+        return Recipe.objects.for_read()
+
+    @cache_anonymous_response
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    # Кеш анонимного ответа снаружи ETag: попадание не трогает БД,
+    # а авторизованные пользователи по-прежнему получают 304.
+    @cache_anonymous_response
+    @method_decorator(etag(recipe_etag))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
     def get_serializer_class(self):
         if self.request.method in ('POST', 'PATCH', 'DELETE'):
             return RecipeCreateSerializer
         return RecipeSerializer
 
+    def toggle_recipe(self, request, pk, model, already_in_error,
+                      not_in_error):
+        if request.method == 'POST':
+            recipe = get_object_or_404(
+                Recipe.objects.only('id', 'name', 'image', 'image_variants',
+                                    'image_failed', 'cooking_time'),
+                id=pk
+            )
+            if not model.objects.add(request.user, recipe.id):
+                return Response({'error': already_in_error},
+                                status.HTTP_400_BAD_REQUEST)
+            serializer = ReceipSmallSerializer(recipe)
+            return Response(serializer.data, status.HTTP_201_CREATED)
+        if not model.objects.remove(request.user, pk):
+            get_object_or_404(Recipe, id=pk)
+            return Response({'error': not_in_error},
+                            status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
     @action(methods=['post', 'delete'],
             detail=True,
             permission_classes=[permissions.IsAuthenticated])
     def favorite(self, request, pk=None):
-        user = request.user
-        recipe = get_object_or_404(Recipe, id=pk)
-        data = {
-            'user': user.id,
-            'recipe': pk,
-        }
-        serializer = FavoriteSerializer(data=data)
-        if request.method == 'POST':
-            if serializer.is_valid():
-                serializer.save()
-                return Response(serializer.data, status.HTTP_201_CREATED)
-            return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
-        if not user.favorites.filter(recipe=recipe).exists():
-            data = {
-                'error': RECIPE_FAVORITE_ERROR
-            }
-            return Response(data, status.HTTP_400_BAD_REQUEST)
-        user.favorites.filter(recipe=recipe).delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        return self.toggle_recipe(request, pk, Favorite,
+                                  RECIPE_FAVORITE_ALLREADY_IN_ERROR,
+                                  RECIPE_FAVORITE_ERROR)
 
     @action(methods=['post', 'delete'],
             detail=True,
             permission_classes=[permissions.IsAuthenticated])
     def shopping_cart(self, request, pk=None):
-        recipe = get_object_or_404(Recipe, id=pk)
-        user = request.user
+        return self.toggle_recipe(request, pk, ShoppingCart,
+                                  SHOPPING_CART_ALLREADY_IN_ERROR,
+                                  SHOPPING_CART_NOT_IN_ERROR)
+
+    def bulk_toggle_recipes(self, request, model):
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        recipes = serializer.validated_data['recipes']
+        recipe_ids = [recipe.id for recipe in recipes]
         if request.method == 'POST':
-            if user.shopping_cart.filter(recipe=recipe).exists():
-                data = {
-                    'error': SHOPPING_CART_ALLREADY_IN_ERROR
-                }
-                return Response(data, status.HTTP_400_BAD_REQUEST)
-            user.shopping_cart.create(recipe=recipe)
-            serializer = ReceipSmallSerializer(recipe)
+            model.objects.add_many(request.user, recipe_ids)
+            serializer = ReceipSmallSerializer(recipes, many=True)
             return Response(serializer.data, status.HTTP_201_CREATED)
-
-        if not user.shopping_cart.filter(recipe=recipe).exists():
-            data = {
-                'error': SHOPPING_CART_NOT_IN_ERROR
-            }
-            return Response(data, status.HTTP_400_BAD_REQUEST)
-        user.shopping_cart.filter(recipe=recipe).delete()
+        model.objects.remove_many(request.user, recipe_ids)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(methods=['post', 'delete'],
+            detail=False,
+            url_path='favorite',
+            url_name='favorite-bulk',
+            permission_classes=[permissions.IsAuthenticated])
+    def favorite_bulk(self, request):
+        return self.bulk_toggle_recipes(request, Favorite)
+
+    @action(methods=['post', 'delete'],
+            detail=False,
+            url_path='shopping_cart',
+            url_name='shopping-cart-bulk',
+            permission_classes=[permissions.IsAuthenticated])
+    def shopping_cart_bulk(self, request):
+        return self.bulk_toggle_recipes(request, ShoppingCart)
+
     @action(methods=['get'],
             detail=False,
             permission_classes=[permissions.IsAuthenticated])
     def download_shopping_cart(self, request, pk=None):
-        ingredients = IngredientRecipe.objects.filter(
-            recipe__shopping_cart__user=request.user
-        ).values(
-            'ingredient__name',
-            'ingredient__measurement_unit'
-        ).annotate(ingredient_amount=Sum('amount'))
-        shopping_list = [' - '.join(map(str, x.values())) + '\n'
-                         for x in ingredients]
-        response = HttpResponse(shopping_list, content_type='text/plain')
+        file_format = request.query_params.get('type', 'txt')
+        if file_format not in EXPORT_FORMATS:
+            return Response(
+                {'errors': 'Доступные форматы: '
+                           + ', '.join(EXPORT_FORMATS)},
+                status.HTTP_400_BAD_REQUEST
+            )
+        render, content_type = EXPORT_FORMATS[file_format]
+        content = render(get_shopping_list(request.user))
+        if file_format == 'pdf':
+            response = FileResponse(content, content_type=content_type)
+        else:
+            response = StreamingHttpResponse(content,
+                                             content_type=content_type)
         response['Content-Disposition'] = \
-            'attachment; filename="shopping_cart.txt"'
+            f'attachment; filename="shopping_cart.{file_format}"'
         return response
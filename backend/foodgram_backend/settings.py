@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
@@ -97,6 +98,18 @@ DATABASES = {
     }
 }
 
+# LocMemCache живёт в памяти одного процесса: поколения кеша и ETag,
+# которые меняют воркеры gunicorn, image_worker и команды manage.py,
+# не видны другим процессам. Он годится только для разработки в одном
+# процессе, в docker-compose используется общий memcached.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND',
+                             'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -139,6 +152,21 @@ STATIC_URL = '/foodgram_static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
+RECIPE_IMAGE_MAX_UPLOAD_SIZE = int(os.getenv('RECIPE_IMAGE_MAX_UPLOAD_SIZE',
+                                             10 * 1024 * 1024))
+RECIPE_IMAGE_MAX_PIXELS = int(os.getenv('RECIPE_IMAGE_MAX_PIXELS', 40000000))
+
+# Без воркера process_image_jobs картинки обрабатываются сразу
+# после коммита запроса. По умолчанию так работает режим отладки.
+IMAGE_PROCESSING_SYNC = os.getenv(
+    'IMAGE_PROCESSING_SYNC', str(DEBUG)
+).lower() == 'true'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
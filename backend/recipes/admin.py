@@ -2,8 +2,11 @@ from django.contrib import admin
 from import_export.resources import ModelResource
 from import_export.admin import ImportExportModelAdmin
 
-from recipes.models import (Ingredient,
+from recipes.images import discard_image_variants, schedule_image_processing
+from recipes.models import (ImageJob,
+                            Ingredient,
                             Recipe,
+                            ShoppingListItem,
                             Tag)
 
 
@@ -40,4 +43,26 @@ class RecipeAdmin(admin.ModelAdmin):
     ]
 
     def favorites_amount(self, obj):
-        return obj.favorites.count()
+        return obj.favorites_count
+
+    def save_model(self, request, obj, form, change):
+        image_changed = 'image' in form.changed_data
+        if image_changed and change:
+            discard_image_variants(obj)
+        super().save_model(request, obj, form, change)
+        if image_changed:
+            schedule_image_processing(obj)
+
+    def save_related(self, request, form, formsets, change):
+        # Инлайн с ингредиентами меняет состав рецепта в чужих корзинах,
+        # поэтому вклад рецепта в списки покупок пересчитывается.
+        recipe_ids = [form.instance.id]
+        ShoppingListItem.objects.apply_cart(-1, recipe_ids=recipe_ids)
+        super().save_related(request, form, formsets, change)
+        ShoppingListItem.objects.apply_cart(1, recipe_ids=recipe_ids)
+
+
+@admin.register(ImageJob)
+class ImageJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'recipe', 'created', 'attempts',
+                    'next_attempt_at', 'error')
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .models import ImageJob, Recipe
+
+IMAGE_DIR = 'recipes/images/'
+VARIANTS_DIR = 'recipes/images/variants/'
+MAX_IMAGE_SIZE = 1600
+IMAGE_QUALITY = 82
+MAX_JOB_ATTEMPTS = 3
+# Пауза перед повторной попыткой удваивается: 1, 2, 4... минуты.
+JOB_RETRY_DELAY = timedelta(minutes=1)
+IMAGE_VARIANTS = {
+    'thumbnail': 320,
+    'medium': 800,
+}
+# Формат в API -> (формат Pillow, расширение файла).
+IMAGE_FORMATS = {
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+}
+
+
+def to_rgb(image):
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def resized(image, size):
+    image = image.copy()
+    image.thumbnail((size, size), Image.LANCZOS)
+    return image
+
+
+def encode(image, image_format):
+    output = BytesIO()
+    image.save(output, image_format, quality=IMAGE_QUALITY,
+               optimize=True, progressive=image_format == 'JPEG')
+    return ContentFile(output.getvalue())
+
+
+def variant_names(variants):
+    return [name for formats in variants.values()
+            for name in formats.values()]
+
+
+def process_recipe_image(recipe):
+    """Пережимает картинку рецепта и строит уменьшенные копии."""
+    if recipe.image_variants or not recipe.image:
+        return
+    source = recipe.image
+    storage = source.storage
+    source.open('rb')
+    try:
+        content = source.read()
+    finally:
+        source.close()
+    image = to_rgb(Image.open(BytesIO(content)))
+
+    # Хранилище само называет файлы по хешу содержимого,
+    # поэтому здесь важны только каталог и расширение.
+    image_name = storage.save(f'{IMAGE_DIR}image.jpg',
+                              encode(resized(image, MAX_IMAGE_SIZE), 'JPEG'))
+    variants = {}
+    for variant, size in IMAGE_VARIANTS.items():
+        variant_image = resized(image, size)
+        variants[variant] = {
+            key: storage.save(f'{VARIANTS_DIR}{variant}.{extension}',
+                              encode(variant_image, image_format))
+            for key, (image_format, extension) in IMAGE_FORMATS.items()
+        }
+
+    with transaction.atomic():
+        # Пока картинка пережималась, автор мог заменить её: тогда
+        # результат устарел, а новую картинку обработает своя задача.
+        current = Recipe.objects.select_for_update().filter(
+            pk=recipe.pk
+        ).only('image', 'image_variants').first()
+        if (current is None or current.image.name != source.name
+                or current.image_variants):
+            return
+        recipe.image.name = image_name
+        recipe.image_hash = hashlib.sha256(content).hexdigest()
+        recipe.image_variants = variants
+        recipe.image_failed = False
+        recipe.save(update_fields=['image', 'image_hash', 'image_variants',
+                                   'image_failed', 'updated_at'])
+
+
+def discard_image_variants(recipe):
+    """Сбрасывает копии старой картинки перед заменой её на новую.
+
+    Файлы могут использоваться другими рецептами, поэтому они не
+    удаляются здесь: их убирает команда collect_media_garbage.
+    """
+    recipe.image_hash = ''
+    recipe.image_variants = {}
+    recipe.image_failed = False
+
+
+def schedule_image_processing(recipe):
+    if settings.IMAGE_PROCESSING_SYNC:
+        transaction.on_commit(lambda: process_recipe_image(recipe))
+    else:
+        ImageJob.objects.create(recipe=recipe)
+
+
+def mark_image_failed(recipe_id):
+    with transaction.atomic():
+        recipe = Recipe.objects.select_for_update().filter(
+            pk=recipe_id, image_variants={}
+        ).only('image_failed').first()
+        if recipe is not None:
+            recipe.image_failed = True
+            recipe.save(update_fields=['image_failed', 'updated_at'])
+
+
+def run_image_job():
+    """Обрабатывает одну задачу из очереди, если она есть."""
+    now = timezone.now()
+    with transaction.atomic():
+        job = ImageJob.objects.select_for_update(skip_locked=True).filter(
+            attempts__lt=MAX_JOB_ATTEMPTS, next_attempt_at__lte=now
+        ).first()
+        if job is None:
+            return None
+        # Попытка засчитывается до обработки и коммитится сразу: задача,
+        # которая роняет воркер, не будет выбираться бесконечно, а до
+        # next_attempt_at её не возьмёт и другой воркер.
+        job.attempts += 1
+        job.next_attempt_at = now + JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+        job.save(update_fields=['attempts', 'next_attempt_at'])
+    try:
+        recipe = Recipe.objects.filter(pk=job.recipe_id).first()
+        if recipe is not None:
+            process_recipe_image(recipe)
+    except Exception as error:
+        logging.exception(f'Recipe {job.recipe_id} image failed')
+        job.error = str(error) or type(error).__name__
+        ImageJob.objects.filter(pk=job.pk).update(error=job.error)
+        if job.attempts >= MAX_JOB_ATTEMPTS:
+            mark_image_failed(job.recipe_id)
+    else:
+        job.delete()
+    return job
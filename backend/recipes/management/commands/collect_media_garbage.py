@@ -0,0 +1,55 @@
+import logging
+import posixpath
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from recipes.images import IMAGE_DIR, variant_names
+from recipes.models import Recipe
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(levelname)s %(message)s")
+
+
+def walk(storage, directory):
+    directories, files = storage.listdir(directory)
+    for name in files:
+        yield posixpath.join(directory, name)
+    for subdirectory in directories:
+        yield from walk(storage, posixpath.join(directory, subdirectory))
+
+
+class Command(BaseCommand):
+    help = 'Deleting recipe images that no recipe refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=24,
+                            help="keep files younger than this many hours")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="only report what would be deleted")
+
+    def handle(self, *args, **options):
+        storage = Recipe._meta.get_field('image').storage
+        # Свежие файлы могут принадлежать ещё не закоммиченным рецептам.
+        threshold = timezone.now() - timedelta(hours=options['min_age'])
+        referenced = set()
+        for image, variants in Recipe.objects.values_list(
+            'image', 'image_variants'
+        ).iterator():
+            referenced.add(image)
+            referenced.update(variant_names(variants))
+
+        deleted = freed = 0
+        for name in walk(storage, IMAGE_DIR.rstrip('/')):
+            if name in referenced:
+                continue
+            if storage.get_modified_time(name) > threshold:
+                continue
+            freed += storage.size(name)
+            deleted += 1
+            if not options['dry_run']:
+                storage.delete(name)
+        action = 'would be deleted' if options['dry_run'] else 'deleted'
+        logging.info(f'{deleted} unreferenced files {action}, '
+                     f'{freed / 2 ** 20:.1f} MB')
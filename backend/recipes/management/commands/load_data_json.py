@@ -1,12 +1,174 @@
-import logging
+import csv
+import io
 import json
+import logging
+from itertools import islice
 
 from django.apps import apps
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes.signals import objects_loaded
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(message)s")
 
+READ_CHUNK_SIZE = 64 * 1024
+JSON_SEPARATORS = ' \t\r\n,'
+
+
+def iter_json_array(stream):
+    """Читает JSON-массив объектов по одному элементу за раз."""
+    decoder = json.JSONDecoder()
+    buffer = stream.read(READ_CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise CommandError('JSON file must contain an array')
+    position = 1
+    while True:
+        while True:
+            while (position < len(buffer)
+                   and buffer[position] in JSON_SEPARATORS):
+                position += 1
+            if position < len(buffer):
+                break
+            buffer, position = stream.read(READ_CHUNK_SIZE), 0
+            if not buffer:
+                raise CommandError('Unexpected end of JSON file')
+        if buffer[position] == ']':
+            return
+        while True:
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError as error:
+                chunk = stream.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    raise CommandError(f'Invalid JSON: {error}')
+                buffer, position = buffer[position:] + chunk, 0
+        yield item
+
+
+def iter_csv(stream, fields):
+    reader = csv.reader(stream)
+    if not fields:
+        fields = next(reader, [])
+    for row in reader:
+        if row:
+            yield dict(zip(fields, row))
+
+
+def batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def default_unique_fields(model):
+    for constraint in model._meta.constraints:
+        fields = getattr(constraint, 'fields', None)
+        if fields:
+            return list(fields)
+    return [field.name for field in model._meta.concrete_fields
+            if field.unique and not field.primary_key][:1]
+
+
+class Loader:
+    def __init__(self, model, unique_fields, on_conflict):
+        self.model = model
+        self.unique_fields = unique_fields
+        self.on_conflict = on_conflict
+        self.table = connection.ops.quote_name(model._meta.db_table)
+
+    def columns(self, instances):
+        fields = [field for field in self.model._meta.concrete_fields
+                  if not field.primary_key]
+        return fields, [
+            [field.get_db_prep_save(getattr(instance, field.attname),
+                                    connection) for field in fields]
+            for instance in instances
+        ]
+
+    def conflict_clause(self, fields):
+        if not self.unique_fields:
+            return ''
+        quote = connection.ops.quote_name
+        target = ', '.join(
+            quote(self.model._meta.get_field(name).column)
+            for name in self.unique_fields
+        )
+        updates = [
+            f'{quote(field.column)} = EXCLUDED.{quote(field.column)}'
+            for field in fields if field.name not in self.unique_fields
+        ]
+        if self.on_conflict == 'update' and updates:
+            return (f' ON CONFLICT ({target}) '
+                    f'DO UPDATE SET {", ".join(updates)}')
+        return f' ON CONFLICT ({target}) DO NOTHING'
+
+    def unique(self, instances):
+        """Оставляет одну строку на каждый естественный ключ в пачке.
+
+        PostgreSQL не даёт ON CONFLICT DO UPDATE изменить строку дважды
+        в одном запросе. При обновлении побеждает последняя строка, при
+        пропуске — первая, как при построчной загрузке.
+        """
+        if not self.unique_fields:
+            return instances
+        attnames = [self.model._meta.get_field(name).attname
+                    for name in self.unique_fields]
+        rows = {}
+        for instance in instances:
+            key = tuple(getattr(instance, name) for name in attnames)
+            if self.on_conflict == 'update' or key not in rows:
+                rows[key] = instance
+        return list(rows.values())
+
+    def insert(self, instances):
+        if self.on_conflict == 'ignore' or not self.unique_fields:
+            self.model.objects.bulk_create(
+                instances, ignore_conflicts=self.on_conflict == 'ignore'
+            )
+            return
+        fields, rows = self.columns(instances)
+        quote = connection.ops.quote_name
+        placeholders = ', '.join(
+            ['(' + ', '.join(['%s'] * len(fields)) + ')'] * len(rows)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {self.table} '
+                f'({", ".join(quote(field.column) for field in fields)}) '
+                f'VALUES {placeholders}'
+                + self.conflict_clause(fields),
+                [value for row in rows for value in row]
+            )
+
+    def copy(self, instances):
+        """Быстрая загрузка через COPY во временную таблицу (PostgreSQL)."""
+        fields, rows = self.columns(instances)
+        quote = connection.ops.quote_name
+        columns = ', '.join(quote(field.column) for field in fields)
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS load_data_batch '
+                f'AS SELECT {columns} FROM {self.table} WITH NO DATA'
+            )
+            cursor.execute('TRUNCATE load_data_batch')
+            cursor.cursor.copy_expert(
+                f'COPY load_data_batch ({columns}) FROM STDIN WITH CSV', data
+            )
+            cursor.execute(
+                f'INSERT INTO {self.table} ({columns}) '
+                f'SELECT {columns} FROM load_data_batch'
+                + self.conflict_clause(fields)
+            )
+
 
 class Command(BaseCommand):
     help = 'Creating model objects according the file path specified'
@@ -19,12 +181,59 @@ class Command(BaseCommand):
             type=str,
             help="django app name that the model is connected to"
         )
+        parser.add_argument(
+            '--format', choices=('json', 'csv'),
+            help="file format, guessed from the extension by default"
+        )
+        parser.add_argument(
+            '--fields', nargs='+',
+            help="CSV column names if the file has no header row"
+        )
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="rows per insert")
+        parser.add_argument(
+            '--on-conflict', choices=('ignore', 'update', 'error'),
+            default='ignore',
+            help="what to do with rows that already exist"
+        )
+        parser.add_argument(
+            '--unique-fields', nargs='+',
+            help="natural key, the model's unique constraint by default"
+        )
+        parser.add_argument('--copy', action='store_true',
+                            help="load with PostgreSQL COPY")
 
     def handle(self, *args, **options):
         model = apps.get_model(options['app_name'], options['model_name'])
-        with open(options['path'], 'rt', encoding='utf-8') as f:
-            instance_data = json.load(f)
-            instances = [model(**x) for x in instance_data]
-            model.objects.bulk_create(instances)
-            logging.info(f'Data loaded successfully. Created {len(instances)} '
-                         f'{model.__name__}''s')
+        file_format = options['format'] or (
+            'csv' if options['path'].lower().endswith('.csv') else 'json'
+        )
+        unique_fields = []
+        if options['on_conflict'] != 'error':
+            unique_fields = (options['unique_fields']
+                             or default_unique_fields(model))
+        if options['on_conflict'] == 'update' and not unique_fields:
+            raise CommandError(f'{model.__name__} has no natural key, '
+                               'pass --unique-fields')
+        if options['copy'] and connection.vendor != 'postgresql':
+            raise CommandError('--copy requires PostgreSQL')
+        loader = Loader(model, unique_fields, options['on_conflict'])
+        insert = loader.copy if options['copy'] else loader.insert
+
+        count_before = model.objects.count()
+        processed = 0
+        with open(options['path'], 'rt', encoding='utf-8',
+                  newline='') as f:
+            if file_format == 'csv':
+                items = iter_csv(f, options['fields'])
+            else:
+                items = iter_json_array(f)
+            for batch in batches(items, options['batch_size']):
+                with transaction.atomic():
+                    insert(loader.unique([model(**x) for x in batch]))
+                processed += len(batch)
+                logging.info(f'{processed} rows processed')
+        objects_loaded.send(sender=model)
+        created = model.objects.count() - count_before
+        logging.info(f'Data loaded successfully. Processed {processed} rows, '
+                     f'created {created} {model.__name__}''s')
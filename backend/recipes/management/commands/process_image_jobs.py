@@ -0,0 +1,35 @@
+import logging
+import time
+
+from django.core.management import BaseCommand
+
+from recipes.images import MAX_JOB_ATTEMPTS, run_image_job
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(levelname)s %(message)s")
+
+
+class Command(BaseCommand):
+    help = 'Processing queued recipe images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="exit when the queue is empty")
+        parser.add_argument('--interval', type=float, default=2,
+                            help="seconds to wait for new jobs")
+
+    def handle(self, *args, **options):
+        while True:
+            job = run_image_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+            elif job.error:
+                final = (' and is marked as failed'
+                         if job.attempts >= MAX_JOB_ATTEMPTS else '')
+                logging.warning(f'Recipe {job.recipe_id} image failed '
+                                f'(attempt {job.attempts} of '
+                                f'{MAX_JOB_ATTEMPTS}){final}: {job.error}')
+            else:
+                logging.info(f'Recipe {job.recipe_id} image processed')
@@ -0,0 +1,25 @@
+import logging
+
+from django.core.management import BaseCommand
+
+from recipes.images import process_recipe_image
+from recipes.models import Recipe
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(levelname)s %(message)s")
+
+
+class Command(BaseCommand):
+    help = 'Re-encoding recipe images and building their variants'
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='').filter(image_variants={})
+        processed = 0
+        for recipe in recipes.iterator():
+            try:
+                process_recipe_image(recipe)
+            except Exception as error:
+                logging.warning(f'Recipe {recipe.id}: {error!r}')
+                continue
+            processed += 1
+        logging.info(f'{processed} recipe images processed')
@@ -0,0 +1,21 @@
+import logging
+
+from django.core.management import BaseCommand
+
+from recipes.models import ShoppingListItem
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(levelname)s %(message)s")
+
+
+class Command(BaseCommand):
+    help = 'Rebuilding aggregated shopping lists from shopping carts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int,
+                            help="rebuild the list of this user id only")
+
+    def handle(self, *args, **options):
+        ShoppingListItem.objects.rebuild(options['user'])
+        logging.info('Shopping lists rebuilt. '
+                     f'{ShoppingListItem.objects.count()} items in total')
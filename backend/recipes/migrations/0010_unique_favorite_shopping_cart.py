@@ -0,0 +1,50 @@
+# Generated by Django 3.2.3 on 2023-10-24 11:45
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+USER_RECIPE_MODELS = {
+    'favorites_count': 'Favorite',
+    'shopping_cart_count': 'ShoppingCart',
+}
+
+
+def remove_duplicates(apps, schema_editor):
+    for model_name in USER_RECIPE_MODELS.values():
+        model = apps.get_model('recipes', model_name)
+        first_ids = model.objects.values('user', 'recipe').annotate(
+            first_id=models.Min('id')
+        ).values('first_id')
+        model.objects.exclude(id__in=first_ids).delete()
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    for field, model_name in USER_RECIPE_MODELS.items():
+        model = apps.get_model('recipes', model_name)
+        count = model.objects.filter(
+            recipe=models.OuterRef('pk')
+        ).values('recipe').annotate(count=models.Count('id')).values('count')
+        Recipe.objects.update(
+            **{field: Coalesce(models.Subquery(count), 0)}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_popularity_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='favorite',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_favorite'),
+        ),
+        migrations.AddConstraint(
+            model_name='shoppingcart',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_shopping_cart'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.3 on 2023-10-27 10:40
+
+from django.db import migrations, models
+import recipes.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_imagejob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(default=None, storage=recipes.storage.ContentHashStorage(), upload_to='recipes/images/'),
+        ),
+    ]
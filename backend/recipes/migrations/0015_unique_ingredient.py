@@ -0,0 +1,51 @@
+# Generated by Django 3.2.3 on 2023-10-27 14:10
+
+from django.db import migrations, models
+
+INGREDIENT_OWNERS = {
+    'IngredientRecipe': 'recipe_id',
+    'ShoppingListItem': 'user_id',
+}
+
+
+def merge_duplicates(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    duplicates = Ingredient.objects.values(
+        'name', 'measurement_unit'
+    ).annotate(
+        first_id=models.Min('id'), count=models.Count('id')
+    ).filter(count__gt=1).order_by()
+    for group in duplicates:
+        kept_id = group['first_id']
+        other_ids = list(Ingredient.objects.filter(
+            name=group['name'], measurement_unit=group['measurement_unit']
+        ).exclude(id=kept_id).values_list('id', flat=True))
+        for model_name, owner in INGREDIENT_OWNERS.items():
+            model = apps.get_model('recipes', model_name)
+            for item in model.objects.filter(ingredient_id__in=other_ids):
+                kept = model.objects.filter(
+                    **{owner: getattr(item, owner)}, ingredient_id=kept_id
+                ).first()
+                if kept is None:
+                    item.ingredient_id = kept_id
+                    item.save(update_fields=['ingredient'])
+                    continue
+                kept.amount = (kept.amount or 0) + (item.amount or 0)
+                kept.save(update_fields=['amount'])
+                item.delete()
+        Ingredient.objects.filter(id__in=other_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_recipe_image_content_hash_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(fields=('name', 'measurement_unit'), name='unique_ingredient'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.3 on 2023-10-28 10:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_unique_ingredient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagejob',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Следующая попытка'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='image_failed',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Картинку не удалось обработать'),
+        ),
+    ]
@@ -1,10 +1,21 @@
 from colorfield.fields import ColorField
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import (SearchQuery,
+                                            SearchRank,
+                                            SearchVectorField,
+                                            TrigramSimilarity)
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.functions import Coalesce, RowNumber
+from django.utils import timezone
+
+from .signals import user_recipes_changed
+from .storage import ContentHashStorage
 
 User = get_user_model()
 
+SEARCH_CONFIG = 'russian'
+
 
 class Tag(models.Model):
     name = models.CharField(max_length=256, unique=True)
@@ -28,18 +39,83 @@ class Ingredient(models.Model):
     class Meta:
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'measurement_unit'],
+                                    name='unique_ingredient'),
+        ]
 
     def __str__(self):
         return self.name
 
 
+class RecipeQuerySet(models.QuerySet):
+
+    def for_read(self):
+        return self.select_related('author').defer('search_vector')
+
+    def popular(self):
+        return self.order_by('-favorites_count', '-pub_date', '-id')
+
+    def change_counter(self, pk, field, delta):
+        return self.filter(pk=pk).update(
+            **{field: models.F(field) + delta}
+        )
+
+    def search(self, query):
+        if connection.vendor != 'postgresql':
+            return self.filter(
+                models.Q(name__icontains=query)
+                | models.Q(text__icontains=query)
+            ).annotate(
+                rank=models.Case(
+                    models.When(name__icontains=query, then=1),
+                    default=0,
+                    output_field=models.IntegerField(),
+                )
+            ).order_by('-rank', '-pub_date')
+        search_query = SearchQuery(query,
+                                   config=SEARCH_CONFIG,
+                                   search_type='websearch')
+        return self.filter(
+            models.Q(search_vector=search_query)
+            | models.Q(name__trigram_similar=query)
+        ).annotate(
+            rank=SearchRank(models.F('search_vector'), search_query),
+            similarity=TrigramSimilarity('name', query),
+        ).order_by('-rank', '-similarity', '-pub_date')
+
+    def latest_by_author(self, authors, limit=None):
+        queryset = self.filter(author__in=authors).only(
+            'id', 'name', 'image', 'image_variants', 'image_failed',
+            'cooking_time', 'author_id', 'pub_date'
+        ).order_by('-pub_date', '-id')
+        if not limit:
+            return queryset
+        ranked = queryset.annotate(row_number=models.Window(
+            expression=RowNumber(),
+            partition_by=[models.F('author_id')],
+            order_by=[models.F('pub_date').desc(), models.F('id').desc()],
+        ))
+        sql, params = ranked.query.sql_with_params()
+        return self.raw(
+            f'SELECT * FROM ({sql}) AS ranked '
+            'WHERE row_number <= %s ORDER BY author_id, row_number',
+            (*params, limit)
+        )
+
+
 class Recipe(models.Model):
     name = models.CharField(max_length=200)
     text = models.TextField()
     image = models.ImageField(
         upload_to='recipes/images/',
+        storage=ContentHashStorage(),
         default=None
     )
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
+    image_variants = models.JSONField(default=dict, editable=False)
+    image_failed = models.BooleanField('Картинку не удалось обработать',
+                                       default=False, editable=False)
     author = models.ForeignKey(
         User,
         related_name='recipes',
@@ -52,6 +128,13 @@ class Recipe(models.Model):
         through='IngredientRecipe',
         related_name='recipes')
     pub_date = models.DateTimeField('Дата публикации', auto_now_add=True)
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+    favorites_count = models.PositiveIntegerField(
+        'В избранном', default=0, editable=False
+    )
+    shopping_cart_count = models.PositiveIntegerField(
+        'В списках покупок', default=0, editable=False
+    )
     cooking_time = models.PositiveSmallIntegerField(
         'Время приготовления',
         validators=(MinValueValidator(
@@ -59,9 +142,18 @@ class Recipe(models.Model):
             'Время приготовление не должно быть меньше 1'
         ),)
     )
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
-        ordering = ['-pub_date']
+        ordering = ['-pub_date', '-id']
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=['-favorites_count', '-pub_date'],
+                         name='recipe_popularity_idx'),
+        ]
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
 
@@ -69,6 +161,17 @@ class Recipe(models.Model):
         return self.name
 
 
+def prefetch_for_read(recipes):
+    models.prefetch_related_objects(
+        recipes,
+        'tags',
+        models.Prefetch(
+            'recipe_ingredients',
+            queryset=IngredientRecipe.objects.select_related('ingredient')
+        ),
+    )
+
+
 class TagRecipe(models.Model):
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
@@ -84,6 +187,101 @@ class IngredientRecipe(models.Model):
     amount = models.IntegerField('Количество', null=True)
 
 
+class UserRecipeManager(models.Manager):
+    def _execute(self, sql, params):
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(table=table), params)
+            return cursor.rowcount
+
+    def _changed(self, user, recipe_ids):
+        user_recipes_changed.send(sender=self.model,
+                                  user=user,
+                                  recipe_ids=recipe_ids)
+
+    def after_add(self, user, recipe_ids):
+        pass
+
+    def before_remove(self, user, recipe_ids):
+        pass
+
+    def refresh_counters(self, recipe_ids):
+        count = self.filter(
+            recipe=models.OuterRef('pk')
+        ).values('recipe').annotate(count=models.Count('id')).values('count')
+        Recipe.objects.filter(id__in=recipe_ids).update(**{
+            self.model.counter_field: Coalesce(models.Subquery(count), 0)
+        })
+
+    def add(self, user, recipe_id):
+        with transaction.atomic():
+            added = self._execute(
+                'INSERT INTO {table} (user_id, recipe_id) VALUES (%s, %s) '
+                'ON CONFLICT DO NOTHING',
+                [user.id, recipe_id]
+            ) == 1
+            if added:
+                Recipe.objects.change_counter(
+                    recipe_id, self.model.counter_field, 1
+                )
+                self.after_add(user, [recipe_id])
+        if added:
+            self._changed(user, [recipe_id])
+        return added
+
+    def remove(self, user, recipe_id):
+        with transaction.atomic():
+            self.before_remove(user, [recipe_id])
+            removed = self._execute(
+                'DELETE FROM {table} WHERE user_id = %s AND recipe_id = %s',
+                [user.id, recipe_id]
+            ) == 1
+            if removed:
+                Recipe.objects.change_counter(
+                    recipe_id, self.model.counter_field, -1
+                )
+        if removed:
+            self._changed(user, [recipe_id])
+        return removed
+
+    def add_many(self, user, recipe_ids):
+        with transaction.atomic():
+            # Уже добавленные рецепты сначала вычитаются, а после вставки
+            # все рецепты из списка учитываются заново: так повторное
+            # добавление не удваивает их вклад.
+            self.before_remove(user, recipe_ids)
+            self.bulk_create(
+                [self.model(user=user, recipe_id=pk) for pk in recipe_ids],
+                ignore_conflicts=True
+            )
+            self.after_add(user, recipe_ids)
+            self.refresh_counters(recipe_ids)
+        self._changed(user, recipe_ids)
+
+    def remove_many(self, user, recipe_ids):
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        with transaction.atomic():
+            self.before_remove(user, recipe_ids)
+            removed = self._execute(
+                'DELETE FROM {table} '
+                f'WHERE user_id = %s AND recipe_id IN ({placeholders})',
+                [user.id, *recipe_ids]
+            )
+            if removed:
+                self.refresh_counters(recipe_ids)
+        if removed:
+            self._changed(user, recipe_ids)
+        return removed
+
+
+class ShoppingCartManager(UserRecipeManager):
+    def after_add(self, user, recipe_ids):
+        ShoppingListItem.objects.apply_cart(1, user.id, recipe_ids)
+
+    def before_remove(self, user, recipe_ids):
+        ShoppingListItem.objects.apply_cart(-1, user.id, recipe_ids)
+
+
 class Favorite(models.Model):
     user = models.ForeignKey(User,
                              on_delete=models.CASCADE,
@@ -92,9 +290,16 @@ class Favorite(models.Model):
                                on_delete=models.CASCADE,
                                related_name='favorites')
 
+    objects = UserRecipeManager()
+    counter_field = 'favorites_count'
+
     class Meta:
         verbose_name = 'Избранное'
         verbose_name_plural = 'Избранное'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'recipe'],
+                                    name='unique_favorite'),
+        ]
 
 
 class ShoppingCart(models.Model):
@@ -105,6 +310,108 @@ class ShoppingCart(models.Model):
                                on_delete=models.CASCADE,
                                related_name='shopping_cart')
 
+    objects = ShoppingCartManager()
+    counter_field = 'shopping_cart_count'
+
     class Meta:
         verbose_name = 'Корзина'
         verbose_name_plural = 'Корзина'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'recipe'],
+                                    name='unique_shopping_cart'),
+        ]
+
+
+class ShoppingListManager(models.Manager):
+    def _tables(self):
+        quote = connection.ops.quote_name
+        return {
+            'items': quote(self.model._meta.db_table),
+            'cart': quote(ShoppingCart._meta.db_table),
+            'ingredients': quote(IngredientRecipe._meta.db_table),
+        }
+
+    def _cart_conditions(self, user_id, recipe_ids):
+        conditions, params = ['1 = 1'], []
+        if user_id is not None:
+            conditions.append('cart.user_id = %s')
+            params.append(user_id)
+        if recipe_ids is not None:
+            placeholders = ', '.join(['%s'] * len(recipe_ids))
+            conditions.append(f'cart.recipe_id IN ({placeholders})')
+            params.extend(recipe_ids)
+        return ' AND '.join(conditions), params
+
+    def apply_cart(self, sign, user_id=None, recipe_ids=None):
+        tables = self._tables()
+        where, params = self._cart_conditions(user_id, recipe_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {tables["items"]} '
+                '(user_id, ingredient_id, amount) '
+                'SELECT cart.user_id, item.ingredient_id, '
+                '%s * COALESCE(SUM(item.amount), 0) '
+                f'FROM {tables["cart"]} cart '
+                f'JOIN {tables["ingredients"]} item '
+                'ON item.recipe_id = cart.recipe_id '
+                f'WHERE {where} '
+                'GROUP BY cart.user_id, item.ingredient_id '
+                'ON CONFLICT (user_id, ingredient_id) DO UPDATE '
+                f'SET amount = {tables["items"]}.amount + EXCLUDED.amount',
+                [sign, *params]
+            )
+        emptied = self.filter(amount__lte=0)
+        if user_id is not None:
+            emptied = emptied.filter(user_id=user_id)
+        elif recipe_ids is not None:
+            emptied = emptied.filter(user_id__in=ShoppingCart.objects.filter(
+                recipe_id__in=recipe_ids
+            ).values('user_id'))
+        emptied.delete()
+
+    def rebuild(self, user_id=None):
+        items = self.all()
+        if user_id is not None:
+            items = items.filter(user_id=user_id)
+        with transaction.atomic():
+            items.delete()
+            self.apply_cart(1, user_id)
+
+
+class ShoppingListItem(models.Model):
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name='shopping_list')
+    ingredient = models.ForeignKey(Ingredient,
+                                   on_delete=models.CASCADE,
+                                   related_name='+')
+    amount = models.IntegerField('Количество', default=0)
+
+    objects = ShoppingListManager()
+
+    class Meta:
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Список покупок'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ingredient'],
+                                    name='unique_shopping_list_item'),
+        ]
+
+
+class ImageJob(models.Model):
+    recipe = models.ForeignKey(Recipe,
+                               on_delete=models.CASCADE,
+                               related_name='image_jobs')
+    created = models.DateTimeField('Дата создания', auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField('Попытки', default=0)
+    next_attempt_at = models.DateTimeField('Следующая попытка',
+                                           default=timezone.now)
+    error = models.TextField('Ошибка', blank=True)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = 'Обработка картинки'
+        verbose_name_plural = 'Обработка картинок'
+
+    def __str__(self):
+        return f'{self.recipe_id}: {self.attempts}'
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Отправляется после изменения избранного или корзины пользователя
+# в обход save()/delete(): sender — модель, аргументы user и recipe_ids.
+user_recipes_changed = Signal()
+
+# Отправляется после массовой загрузки объектов командой load_data_json
+# в обход save(): sender — модель.
+objects_loaded = Signal()
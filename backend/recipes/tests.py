@@ -0,0 +1,216 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from .images import (MAX_JOB_ATTEMPTS, process_recipe_image, run_image_job,
+                     schedule_image_processing)
+from .management.commands.load_data_json import Loader
+from .models import ImageJob, Ingredient, Recipe, Tag
+
+User = get_user_model()
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def image_file(color='red'):
+    output = BytesIO()
+    Image.new('RGB', (40, 30), color).save(output, 'PNG')
+    return SimpleUploadedFile('recipe.png', output.getvalue(), 'image/png')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, IMAGE_PROCESSING_SYNC=False)
+class ImageJobTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.org', username='author',
+            first_name='Иван', last_name='Иванов', password='password'
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.recipe = Recipe.objects.create(
+            author=self.author, name='Рецепт', text='Описание',
+            cooking_time=10, image=image_file()
+        )
+        schedule_image_processing(self.recipe)
+
+    def test_job_processed(self):
+        job = run_image_job()
+        self.assertEqual(job.error, '')
+        self.assertFalse(ImageJob.objects.exists())
+        self.recipe.refresh_from_db()
+        self.assertEqual(set(self.recipe.image_variants),
+                         {'thumbnail', 'medium'})
+        self.assertFalse(self.recipe.image_failed)
+
+    @mock.patch('recipes.images.process_recipe_image',
+                side_effect=MemoryError)
+    def test_failing_job_backs_off_and_gives_up(self, process):
+        for attempt in range(1, MAX_JOB_ATTEMPTS + 1):
+            with self.assertLogs(level='ERROR'):
+                job = run_image_job()
+            self.assertEqual(job.attempts, attempt)
+            self.assertEqual(job.error, 'MemoryError')
+            stored = ImageJob.objects.get()
+            self.assertEqual(stored.attempts, attempt)
+            self.assertGreater(stored.next_attempt_at, timezone.now())
+            # До next_attempt_at задача не выбирается повторно.
+            self.assertIsNone(run_image_job())
+            ImageJob.objects.update(
+                next_attempt_at=timezone.now() - timedelta(seconds=1)
+            )
+            self.recipe.refresh_from_db()
+            self.assertEqual(self.recipe.image_failed,
+                             attempt == MAX_JOB_ATTEMPTS)
+        self.assertIsNone(run_image_job())
+        self.assertEqual(process.call_count, MAX_JOB_ATTEMPTS)
+
+    def test_replaced_image_is_not_overwritten(self):
+        stale = Recipe.objects.get(pk=self.recipe.pk)
+        self.recipe.image = image_file('blue')
+        self.recipe.save()
+        process_recipe_image(stale)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.image_variants, {})
+        self.assertNotEqual(self.recipe.image.name, stale.image.name)
+
+
+class LoadDataTest(TestCase):
+    def setUp(self):
+        Tag.objects.create(name='Старый', color='#000000', slug='old')
+
+    def write(self, content, suffix='.json'):
+        file = tempfile.NamedTemporaryFile('w', suffix=suffix,
+                                           encoding='utf-8', delete=False)
+        with file:
+            file.write(content if isinstance(content, str)
+                       else json.dumps(content, ensure_ascii=False))
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def load(self, path, model_name='Tag', **options):
+        with self.assertLogs(level='INFO'):
+            call_command('load_data_json', path=path, model_name=model_name,
+                         app_name='recipes', **options)
+
+    def tags(self):
+        return dict(Tag.objects.values_list('slug', 'name'))
+
+    def tag_file(self):
+        return self.write([
+            {'name': 'Новый', 'color': '#111111', 'slug': 'old'},
+            {'name': 'Завтрак', 'color': '#222222', 'slug': 'breakfast'},
+            {'name': 'Утро', 'color': '#333333', 'slug': 'breakfast'},
+        ])
+
+    def test_on_conflict_ignore_keeps_first(self):
+        for batch_size in (1000, 1):
+            with self.subTest(batch_size=batch_size):
+                self.load(self.tag_file(), on_conflict='ignore',
+                          unique_fields=['slug'], batch_size=batch_size)
+                self.assertEqual(self.tags(),
+                                 {'old': 'Старый', 'breakfast': 'Завтрак'})
+                Tag.objects.filter(slug='breakfast').delete()
+
+    def test_on_conflict_update_keeps_last(self):
+        for batch_size in (1000, 1):
+            with self.subTest(batch_size=batch_size):
+                self.load(self.tag_file(), on_conflict='update',
+                          unique_fields=['slug'], batch_size=batch_size)
+                self.assertEqual(self.tags(),
+                                 {'old': 'Новый', 'breakfast': 'Утро'})
+                Tag.objects.filter(slug='breakfast').delete()
+
+    def test_batch_deduplicated_by_natural_key(self):
+        tags = [Tag(name=name, slug=slug) for name, slug in
+                (('Завтрак', 'breakfast'), ('Обед', 'lunch'),
+                 ('Утро', 'breakfast'))]
+        for on_conflict, expected in (('ignore', ['Завтрак', 'Обед']),
+                                      ('update', ['Утро', 'Обед'])):
+            with self.subTest(on_conflict=on_conflict):
+                loader = Loader(Tag, ['slug'], on_conflict)
+                self.assertEqual([tag.name for tag in loader.unique(tags)],
+                                 expected)
+        self.assertEqual(len(Loader(Tag, [], 'error').unique(tags)), 3)
+
+    def test_on_conflict_error(self):
+        path = self.write([
+            {'name': 'Обед', 'color': '#111111', 'slug': 'lunch'},
+            {'name': 'Другой', 'color': '#222222', 'slug': 'old'},
+        ])
+        with self.assertRaises(IntegrityError):
+            call_command('load_data_json', path=path, model_name='Tag',
+                         app_name='recipes', on_conflict='error')
+        self.assertEqual(self.tags(), {'old': 'Старый'})
+
+    def test_default_natural_key(self):
+        Ingredient.objects.create(name='Сахар', measurement_unit='г')
+        path = self.write([
+            {'name': 'Сахар', 'measurement_unit': 'г'},
+            {'name': 'Сахар', 'measurement_unit': 'кг'},
+            {'name': 'Сахар', 'measurement_unit': 'кг'},
+        ])
+        for on_conflict in ('ignore', 'update'):
+            with self.subTest(on_conflict=on_conflict):
+                self.load(path, 'Ingredient', on_conflict=on_conflict)
+                self.assertEqual(Ingredient.objects.count(), 2)
+
+    def test_csv(self):
+        files = (
+            (self.write('name,measurement_unit\nСоль,г\n\nМука,кг\n',
+                        '.csv'), {}),
+            (self.write('Соль,г\nМука,кг\n', '.csv'),
+             {'fields': ['name', 'measurement_unit']}),
+        )
+        for path, options in files:
+            with self.subTest(options=options):
+                self.load(path, 'Ingredient', **options)
+                self.assertEqual(
+                    set(Ingredient.objects.values_list('name',
+                                                       'measurement_unit')),
+                    {('Соль', 'г'), ('Мука', 'кг')}
+                )
+                Ingredient.objects.all().delete()
+
+    def test_json_read_in_small_chunks(self):
+        names = [f'Ингредиент {i}' for i in range(20)]
+        path = self.write(' \n[' + ',\n'.join(
+            json.dumps({'name': name, 'measurement_unit': 'г'},
+                       ensure_ascii=False)
+            for name in names
+        ) + ']\n')
+        with mock.patch(
+            'recipes.management.commands.load_data_json.READ_CHUNK_SIZE', 7
+        ):
+            self.load(path, 'Ingredient', batch_size=3)
+        self.assertEqual(
+            sorted(Ingredient.objects.values_list('name', flat=True)),
+            sorted(names)
+        )
+
+    @skipUnless(connection.vendor == 'postgresql', 'COPY requires PostgreSQL')
+    def test_copy(self):
+        for on_conflict, expected in (('ignore', 'Завтрак'),
+                                      ('update', 'Утро')):
+            with self.subTest(on_conflict=on_conflict):
+                self.load(self.tag_file(), on_conflict=on_conflict,
+                          unique_fields=['slug'], copy=True)
+                self.assertEqual(self.tags()['breakfast'], expected)
+                Tag.objects.filter(slug='breakfast').delete()
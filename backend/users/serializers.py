@@ -2,6 +2,8 @@ from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from djoser.serializers import UserSerializer, UserCreateSerializer
 
+from .utils import get_subscribed_ids
+
 
 User = get_user_model()
 
@@ -20,7 +22,4 @@ class CustomUserSerializer(UserSerializer):
                   'first_name', 'last_name', 'is_subscribed')
 
     def get_is_subscribed(self, obj):
-        request = self.context.get('request')
-        if request is None or not request.user.is_authenticated:
-            return False
-        return request.user.following.filter(author=obj).exists()
+        return obj.id in get_subscribed_ids(self.context.get('request'))
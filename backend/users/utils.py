@@ -0,0 +1,13 @@
+from .models import Subscription
+
+
+def get_subscribed_ids(request):
+    if request is None or not request.user.is_authenticated:
+        return frozenset()
+    if not hasattr(request, '_subscribed_ids'):
+        request._subscribed_ids = set(
+            Subscription.objects.filter(
+                user=request.user
+            ).values_list('author_id', flat=True)
+        )
+    return request._subscribed_ids